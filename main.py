@@ -86,7 +86,7 @@ async def main():
         if site:
             # Step 3: Build clone using the enhanced injection workflow
             try:
-                site = enhanced_injection_workflow(site)
+                site = await enhanced_injection_workflow(site)
                 print("Enhanced cloning complete! Check the 'cloned_injection' folder for results.")
             except Exception as e:
                 print(f"Error in enhanced injection workflow: {e}")
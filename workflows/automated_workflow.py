@@ -1,6 +1,6 @@
 from data_models import Site, Page
 import os
-from workflows.automation_utils import extract_assets_from_html, truncate_repeated_elements
+from workflows.automation_utils import extract_assets_from_html, truncate_repeated_elements, create_asset_session
 from urllib.parse import urlparse
 from bs4 import BeautifulSoup
 import asyncio
@@ -8,6 +8,11 @@ import re
 import json
 
 async def automated_workflow(playwright_page, site):
+    # One HTTP session is shared by every page so asset downloads reuse connections
+    async with create_asset_session() as asset_session:
+        return await process_pages(playwright_page, site, asset_session)
+
+async def process_pages(playwright_page, site, asset_session):
     pages = list(site.get_pages())  # Convert to list to avoid modification during iteration
     
     for page in pages:
@@ -44,7 +49,7 @@ async def automated_workflow(playwright_page, site):
                 print(f"Error getting page content: {e}")
                 continue  # Skip this page if we can't get content
                 
-            soup = BeautifulSoup(html, "html.parser")
+            soup = BeautifulSoup(html, "lxml")
 
             scripts_removed = 0
             styles_removed = 0
@@ -204,7 +209,7 @@ async def automated_workflow(playwright_page, site):
                     print(f"Error processing link in HTML: {e}")
 
             try:
-                page = extract_assets_from_html(truncated_html, url, page)
+                page = await extract_assets_from_html(truncated_html, url, page, session=asset_session)
             except Exception as e:
                 print(f"Error extracting assets: {e}")
                 
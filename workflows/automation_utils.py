@@ -1,38 +1,181 @@
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from data_models import Asset
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import mimetypes
 from urllib.parse import urlparse, urljoin
+import functools
 import hashlib
+import xxhash
+import asyncio
+import contextlib
+import aiohttp
+import aiofiles
 import re
+import shutil
+from collections import Counter, defaultdict
+import numpy as np
+import soupsieve
 
-def extract_assets_from_html(html_content, page_url, page):
+# Number of sibling elements above which the similarity check is vectorized
+VECTORIZE_MIN_CHILDREN = 64
+
+# Once this many truncations have been made, the optional later passes in
+# truncate_repeated_elements are skipped since they add little to context trimming
+MAX_TRUNCATIONS = 40
+
+# Number of assets downloaded concurrently per page
+MAX_CONCURRENT_DOWNLOADS = 20
+
+# Hash used to name cached files; xxh64 is much faster than md5 and these keys aren't security sensitive
+HASH_ALGO = 'xxh64'
+
+# Matches url(...) references inside inline style attributes
+STYLE_URL_RE = re.compile(r'url\([\'"]?(.*?)[\'"]?\)')
+
+# Shared HTTP session for JavaScript downloads; brotli is decoded by the Brotli package.
+# The pool is sized for concurrent callers so downloads reuse connections.
+SESSION = requests.Session()
+SESSION.headers['Accept-Encoding'] = 'br, gzip'
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=Retry(total=2, backoff_factor=0.3))
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
+
+# Common selectors for carousels, grids, and repeated elements
+GRID_SELECTOR_PATTERNS = [
+    # Uber Eats specific menu item selectors
+    #"ul.k8.nj.nk.nl.nm.nn.no.ae",
+    #"ul.k8.qb.qc.nl.nm.nn.no.qe.qf",  # Menu items container from your example
+    #"li.np.nq.nr.ak.ns",
+    #"li.np.nq.nr.qg.ak.bb.i7.gn",  # From your example
+    #"div[data-testid^='store-item']",
+    #"a[href*='mod=quickView']",
+    #"div.cd.al.nt.ak",
+    
+    # Carousels
+    "ul.f4.cs.bh.nq.gn.nr",
+    "ul.f9.ak.gn.ns",
+    "ul[data-testid='carousel']",
+    "div.carousel",
+    "div.slider",
+    "ul.carousel-items",
+    "div[data-testid='carousel-slide']",
+    "ul.f4.cs.bh.no.gl.np",
+    "ul.al.f4.cs.bh.no.gl.np",
+    "ul.al.f4.cs.bh.np.gn.nq",
+    "ul.dv.er.c9.cd.ng.c4.nh.ni.mi.af",
+    
+    # Grids
+    "div.grid",
+    "div.grid-container",
+    "ul.grid",
+    "div.products-grid",
+    "div.items-grid",
+    "div.gallery",
+    
+    # Lists
+    "ul.product-list",
+    "div.product-list",
+    "ul.items",
+    "div.items-container",
+    
+    # Common e-commerce patterns
+    "div.products",
+    "ul.products",
+    "div.search-results",
+    "div.collection-products",
+    
+    # Store/restaurant card grids
+    "div[data-testid='store-card']",
+    "div.m9.p0.p1[data-testid='store-card']",
+    "div.store-list",
+    "div.restaurants-list",
+    "li[data-testid='carousel-slide']",
+    "div.l7.al.l9.la.nn",
+    
+    # Uber Eats specific patterns
+    "div.f4.f8.bs.m0.ly",
+    "li.f9.ak.gn.nr",
+    "div.ak.bu",
+    "ol.ak.al.bh.ly.m0.mr",
+]
+
+# Tags extract_assets_from_html reads assets from. Styled elements aren't included since
+# the inline-style url() scan is disabled; re-enabling it needs a full parse.
+ASSET_TAGS_STRAINER = SoupStrainer(["img", "link", "script"])
+
+# How extract_assets_from_html turns elements into assets:
+# (tag, required rel, URL attribute, asset type, page.assets list, text attribute)
+ASSET_DISPATCH = [
+    ('img', None, 'src', 'img', 'imgs', 'alt'),
+    ('link', 'stylesheet', 'href', 'css', 'styling', None),
+]
+ASSET_DISPATCH_TAGS = sorted({entry[0] for entry in ASSET_DISPATCH})
+
+# Child tags considered when detecting grid-like parents
+GRID_CHILD_TAGS = {"div", "li", "article"}
+
+# Tags whose contents the truncation walk never indexes. The tags themselves stay
+# in the soup (the output is the whole page), their subtrees just aren't visited.
+# noscript and template are still walked: lxml parses their contents as real elements.
+WALK_SKIP_TAGS = {"script", "style", "svg"}
+
+# Compiled once at import so the grid pass doesn't re-parse each selector per page
+GRID_SELECTORS = [soupsieve.compile(pattern) for pattern in GRID_SELECTOR_PATTERNS]
+
+async def extract_assets_from_html(html_content, page_url, page, session=None):
     """
     Uses the page's HTML and URL to update the assets object
-    of the page.
+    of the page. Pass an aiohttp session from create_asset_session
+    to reuse connections across pages.
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
+    # Only build nodes for the tags assets are read from
+    soup = BeautifulSoup(html_content, 'lxml', parse_only=ASSET_TAGS_STRAINER)
     base_url = '/'.join(page_url.split('/')[:3])
     
     # Directory to save assets
     page_assets_dir = os.path.join("assets", page.dir)
     os.makedirs(page_assets_dir, exist_ok=True)
     
-    for img in soup.find_all('img'):
-        src = img.get('src')
-        text = img.get('alt')
-        if src:
-            asset_url, file_path = download_asset(src, base_url, page_assets_dir, 'img')
-            if file_path:
-                page.assets.imgs.append(Asset(url=file_path, asset_type='img', text=text))
+    # Collect (src, asset_type, assets list, text) for every asset in one walk so downloads can overlap
+    tasks = []
+    for element in soup.find_all(ASSET_DISPATCH_TAGS):
+        for tag, rel, url_attr, asset_type, assets_list, text_attr in ASSET_DISPATCH:
+            if element.name == tag and (rel is None or rel in element.get('rel', [])):
+                src = element.get(url_attr)
+                if src:
+                    tasks.append((src, asset_type, assets_list, element.get(text_attr) if text_attr else None))
+                break
     
-    for link in soup.find_all('link', rel='stylesheet'):
-        href = link.get('href')
-        if href:
-            asset_url, file_path = download_asset(href, base_url, page_assets_dir, 'css')
-            if file_path:
-                page.assets.styling.append(Asset(url=file_path, asset_type='css'))
+    # Open a session for this page only if the caller didn't share one
+    owns_session = session is None
+    if owns_session:
+        session = create_asset_session()
+    try:
+        # The same icon or image is often referenced many times on a page, so each
+        # resolved URL is downloaded once and its result shared by every reference
+        unique_downloads = {}
+        for src, asset_type, _, _ in tasks:
+            unique_downloads.setdefault(resolve_asset_url(src, base_url), (src, asset_type))
+        
+        # Snapshot what is already on disk once instead of stat-ing every asset
+        existing_files = snapshot_files(page_assets_dir)
+        
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+        results = await asyncio.gather(*(download_asset(src, base_url, page_assets_dir, asset_type, session, semaphore, existing_files)
+                                         for src, asset_type in unique_downloads.values()))
+        results_by_url = dict(zip(unique_downloads, results))
+    finally:
+        if owns_session:
+            await session.close()
+    
+    # Fan results back out in page order
+    for src, asset_type, assets_list, text in tasks:
+        asset_url, file_path = results_by_url[resolve_asset_url(src, base_url)]
+        if file_path:
+            getattr(page.assets, assets_list).append(Asset(url=file_path, asset_type=asset_type, text=text))
     
     # Process JavaScript files
     """ for script in soup.find_all('script', src=True):
@@ -69,7 +212,7 @@ def extract_assets_from_html(html_content, page_url, page):
     
     for element in soup.find_all(style=True):
         style = element['style']
-        urls = re.findall(r'url\([\'"]?(.*?)[\'"]?\)', style)
+        urls = STYLE_URL_RE.findall(style)
         for url in urls:
             asset_url, file_path = download_asset(url, base_url, page_assets_dir, 'bg-img')
             if file_path:
@@ -78,55 +221,136 @@ def extract_assets_from_html(html_content, page_url, page):
     return page
 
 
-def download_asset(asset_url, base_url, save_dir, asset_type):
+def hash_hex(data):
+    """
+    Returns the hex digest of data using HASH_ALGO.
+    """
+    if HASH_ALGO == 'xxh64':
+        return xxhash.xxh64(data).hexdigest()
+    return hashlib.new(HASH_ALGO, data).hexdigest()
+
+def create_asset_session():
+    """
+    Creates an aiohttp session for asset downloads. Must be called
+    from within a running event loop.
+    """
+    connector = aiohttp.TCPConnector(limit=64, limit_per_host=8)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=10))
+
+@functools.lru_cache(maxsize=4096)
+def resolve_asset_url(asset_url, base_url):
+    """
+    Resolves protocol-relative and relative asset URLs against the page's base URL.
+    Cached since the same references are resolved repeatedly within and across pages.
+    """
+    if asset_url.startswith('//'):
+        return 'https:' + asset_url
+    elif not (asset_url.startswith('http://') or asset_url.startswith('https://')):
+        return urljoin(base_url, asset_url)
+    return asset_url
+
+def snapshot_files(directory):
+    """
+    Returns the normalized paths of every file under directory.
+    """
+    return {os.path.normpath(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names}
+
+async def download_asset(asset_url, base_url, save_dir, asset_type, session, semaphore=None, existing_files=None):
     try:
         original_url = asset_url  
-        if asset_url.startswith('//'):
-            asset_url = 'https:' + asset_url
-        elif not (asset_url.startswith('http://') or asset_url.startswith('https://')):
-            asset_url = urljoin(base_url, asset_url)
-
-        # Download the asset (to inspect headers for content-type, etc.)
-        response = requests.get(asset_url, timeout=10)
-        if response.status_code != 200:
-            # print(f"Skipping {asset_url} because of status code {response.status_code}")
-            return None, None
+        asset_url = resolve_asset_url(asset_url, base_url)
 
-        """ # Retrieve the content type
-        content_type = response.headers.get("content-type", "").lower()
-        guessed_ext = None
-        if content_type:
-            guessed_ext = mimetypes.guess_extension(content_type, strict=False)
+        file_path = os.path.join(save_dir, original_url)
+        etag_path = file_path + '.etag'
 
-        # Extract a filename portion from the URL (excluding query params)
-        parsed_url = urlparse(asset_url)
-        basename = os.path.basename(parsed_url.path)
-
-        # If the URL does not have a valid extension, try the content-type guess
-        _, ext_in_url = os.path.splitext(basename)
-        # If the ext_in_url is something like '.jpg', keep it
-        # but if it's missing or not an actual image extension, try the guessed_ext
-        valid_image_exts = {'.png', '.jpg', '.jpeg', '.gif', '.svg', '.webp', '.bmp', '.ico'}
-        if not ext_in_url.lower() in valid_image_exts:
-            ext_in_url = guessed_ext or ext_in_url  # fallback to guessed_ext
-            if not ext_in_url:
-                # If we still don't have anything, fallback to .png or use your function:
-                ext_in_url = get_extension_from_asset_type(asset_type)
-
-        url_hash = hashlib.md5(asset_url.encode('utf-8')).hexdigest()
-        final_ext = ext_in_url if ext_in_url.startswith('.') else f".{ext_in_url}"
-        filename = f"{asset_type}_{url_hash}{final_ext}" """
+        # Skip the network entirely if the file already exists and has no stored validators,
+        # otherwise revalidate it with a conditional GET
+        if existing_files is not None:
+            file_exists = os.path.normpath(file_path) in existing_files
+            etag_exists = os.path.normpath(etag_path) in existing_files
+        else:
+            file_exists = os.path.exists(file_path)
+            etag_exists = os.path.exists(etag_path)
         
-        file_path = os.path.join(save_dir, original_url)
+        headers = {}
+        if file_exists:
+            if not etag_exists:
+                #print(f"File already exists: {file_path}")
+                return original_url, file_path
+            async with aiofiles.open(etag_path, 'r', encoding='utf-8') as f:
+                etag, _, last_modified = (await f.read()).partition('\n')
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
 
-        # Skip if file already exists
-        if os.path.exists(file_path):
-            #print(f"File already exists: {file_path}")
-            return original_url, file_path
+        # Atomically claim new files so concurrent tasks never download the same path twice
+        fd = None
+        claimed = False
+        downloaded = False
+        if not file_exists:
+            try:
+                fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                claimed = True
+            except FileExistsError:
+                return original_url, file_path
 
-        with open(file_path, 'wb') as f:
-            f.write(response.content)
-        #print(f"Downloaded {asset_type}: {filename}")
+        try:
+            # Download the asset as a stream (headers such as content-type are available before the body)
+            async with semaphore or contextlib.nullcontext(), session.get(asset_url, headers=headers) as response:
+                if response.status == 304:
+                    return original_url, file_path
+                if response.status != 200:
+                    # print(f"Skipping {asset_url} because of status code {response.status}")
+                    return None, None
+
+                """ # Retrieve the content type
+                content_type = response.headers.get("content-type", "").lower()
+                guessed_ext = None
+                if content_type:
+                    guessed_ext = guess_extension(content_type)
+
+                # Extract a filename portion from the URL (excluding query params)
+                parsed_url = urlparse(asset_url)
+                basename = os.path.basename(parsed_url.path)
+
+                # If the URL does not have a valid extension, try the content-type guess
+                _, ext_in_url = os.path.splitext(basename)
+                # If the ext_in_url is something like '.jpg', keep it
+                # but if it's missing or not an actual image extension, try the guessed_ext
+                valid_image_exts = {'.png', '.jpg', '.jpeg', '.gif', '.svg', '.webp', '.bmp', '.ico'}
+                if not ext_in_url.lower() in valid_image_exts:
+                    ext_in_url = guessed_ext or ext_in_url  # fallback to guessed_ext
+                    if not ext_in_url:
+                        # If we still don't have anything, fallback to .png or use your function:
+                        ext_in_url = get_extension_from_asset_type(asset_type)
+
+                url_hash = hash_hex(asset_url.encode('utf-8'))
+                final_ext = ext_in_url if ext_in_url.startswith('.') else f".{ext_in_url}"
+                filename = f"{asset_type}_{url_hash}{final_ext}" """
+
+                # Write the body in 64 KiB chunks instead of buffering it in memory
+                target = file_path if fd is None else fd
+                fd = None  # The file object below now owns the descriptor
+                async with aiofiles.open(target, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        await f.write(chunk)
+                downloaded = True
+                #print(f"Downloaded {asset_type}: {filename}")
+
+                # Persist validators so the next crawl can issue a conditional GET
+                etag = response.headers.get('ETag', '')
+                last_modified = response.headers.get('Last-Modified', '')
+                if etag or last_modified:
+                    async with aiofiles.open(etag_path, 'w', encoding='utf-8') as f:
+                        await f.write(f"{etag}\n{last_modified}")
+
+        finally:
+            # Don't leave empty or partial files behind if the download didn't finish
+            if claimed and not downloaded:
+                if fd is not None:
+                    os.close(fd)
+                os.unlink(file_path)
 
         return original_url, file_path
 
@@ -134,6 +358,13 @@ def download_asset(asset_url, base_url, save_dir, asset_type):
         print(f"Error downloading {asset_type} from {asset_url}: {e}")
         return None, None
 
+@functools.lru_cache(maxsize=64)
+def guess_extension(content_type):
+    """
+    Cached mimetypes lookup; only a handful of content types show up in practice.
+    """
+    return mimetypes.guess_extension(content_type, strict=False)
+
 def get_extension_from_asset_type(asset_type):
     extensions = {
         'img': '.jpg',
@@ -145,7 +376,7 @@ def get_extension_from_asset_type(asset_type):
     return extensions.get(asset_type, '')
 
 # Function to detect and truncate grid-like elements
-def truncate_repeated_elements(soup, max_items=5, max_carousels=2, max_menu_sections=3):
+def truncate_repeated_elements(soup, max_items=5, max_carousels=2, max_menu_sections=3, max_truncations=500):
     """
     Detects and truncates grid-like or repeated elements in the HTML.
     Returns the number of elements truncated.
@@ -155,11 +386,46 @@ def truncate_repeated_elements(soup, max_items=5, max_carousels=2, max_menu_sect
     - max_items: Maximum number of items to keep in each grid/list (default: 5)
     - max_carousels: Maximum number of carousel sections to keep (default: 2)
     - max_menu_sections: Maximum number of menu sections to keep (default: 3)
+    - max_truncations: Stop once this many truncations have been made (default: 500)
     """
     try:
         truncated_count = 0
         carousel_count = 0
         
+        # Walk the tree once and index every element the passes below need.
+        # Passes decompose elements as they go, so each index is filtered on use.
+        structure_groups = {tag: {} for tag in ["li", "div", "article", "a"]}
+        data_testid_values = defaultdict(list)
+        elements_by_tag = {tag: [] for tag in ["div", "ul", "section"]}
+        fallback_tags = {"div", "section", "main", "ul"}
+        fallback_candidates = []
+        # Number of ancestors (including the soup itself) of each grid candidate
+        element_depths = {}
+        # Depth-first over .contents so opaque subtrees (scripts, svg paths) can be skipped
+        stack = [(child, 1) for child in reversed(soup.contents)]
+        while stack:
+            element, depth = stack.pop()
+            name = getattr(element, "name", None)
+            if name is None:
+                continue
+            if name not in WALK_SKIP_TAGS:
+                stack.extend((child, depth + 1) for child in reversed(element.contents))
+            if name in elements_by_tag:
+                elements_by_tag[name].append(element)
+                element_depths[id(element)] = depth
+            if name in fallback_tags:
+                fallback_candidates.append(element)
+            
+            testid = element.get("data-testid")
+            if testid:
+                data_testid_values[testid].append(element)
+            
+            # Key repeated elements by tag name and classes
+            if name in structure_groups:
+                classes = element.get('class')
+                if classes:
+                    structure_groups[name].setdefault(f"{name}:{'.'.join(sorted(classes))}", []).append(element)
+        
         # Remove menu sections in store pages
         parent_div = soup.find("div", {"data-testid": "store-desktop-loaded-coi"})
         if parent_div:
@@ -167,9 +433,9 @@ def truncate_repeated_elements(soup, max_items=5, max_carousels=2, max_menu_sect
 
             print(f"Found {len(list_items)} list items inside store-desktop-loaded-coi")
 
-            # Keep only the first three, remove the rest
-            for li in list_items[3:]:  # Skip first 3, remove the rest
-                li.decompose()  # Removes the tag from the tree
+            # Keep only the first three, remove the rest. Nested list items go with
+            # their ancestor, so decompose_all skips the ones already removed.
+            decompose_all(list_items[3:])
 
         
         # Uber Eats specific menu section selectors
@@ -220,16 +486,13 @@ def truncate_repeated_elements(soup, max_items=5, max_carousels=2, max_menu_sect
             if menu_tabs and len(menu_tabs) > max_menu_sections:
                 print(f"Truncating menu tabs from {len(menu_tabs)} to {max_menu_sections}")
                 for tab in menu_tabs[max_menu_sections:]:
-                    try:
-                        # Also remove the corresponding panel
-                        panel_id = tab.get('aria-controls')
-                        if panel_id:
-                            panel = soup.find(id=panel_id)
-                            if panel:
-                                panel.decompose()
-                        tab.decompose()
-                    except Exception as e:
-                        print(f"Error while truncating menu tab: {e}")
+                    # Also remove the corresponding panel
+                    panel_id = tab.get('aria-controls')
+                    if panel_id:
+                        panel = soup.find(id=panel_id)
+                        if panel:
+                            panel.decompose()
+                    tab.decompose()
                 truncated_count += 1
         except Exception as e:
             print(f"Error processing menu tabs: {e}")
@@ -310,12 +573,7 @@ def truncate_repeated_elements(soup, max_items=5, max_carousels=2, max_menu_sect
                 if menu_items and len(menu_items) > max_items:
                     print(f"Truncating menu items in section from {len(menu_items)} to {max_items}")
                     # Keep only the first max_items
-                    for item in menu_items[max_items:]:
-                        try:
-                            if not item.decomposed:
-                                item.decompose()
-                        except Exception as e:
-                            print(f"Error removing menu item: {e}")
+                    decompose_all(menu_items[max_items:])
                     truncated_count += 1
                 elif menu_items:
                     print(f"Section has {len(menu_items)} menu items, no truncation needed")
@@ -327,373 +585,302 @@ def truncate_repeated_elements(soup, max_items=5, max_carousels=2, max_menu_sect
         
         # Now handle other repeated elements
         
-        # Common selectors for carousels, grids, and repeated elements
-        grid_selectors = [
-            # Uber Eats specific menu item selectors
-            #"ul.k8.nj.nk.nl.nm.nn.no.ae",
-            #"ul.k8.qb.qc.nl.nm.nn.no.qe.qf",  # Menu items container from your example
-           # "li.np.nq.nr.ak.ns",
-            #"li.np.nq.nr.qg.ak.bb.i7.gn",  # From your example
-            #"div[data-testid^='store-item']",
-            #"a[href*='mod=quickView']",
-            #"div.cd.al.nt.ak",
-             
-            # Carousels
-            "ul.f4.cs.bh.nq.gn.nr",  
-            "ul.f9.ak.gn.ns",        
-            "ul[data-testid='carousel']",
-            "div.carousel",
-            "div.slider",
-            "ul.carousel-items",
-            "div[data-testid='carousel-slide']",
-            "ul.f4.cs.bh.no.gl.np",
-            "ul.al.f4.cs.bh.no.gl.np",
-            "ul.al.f4.cs.bh.np.gn.nq",
-            "ul.dv.er.c9.cd.ng.c4.nh.ni.mi.af",
-            
-            # Grids
-            "div.grid",
-            "div.grid-container",
-            "ul.grid",
-            "div.products-grid",
-            "div.items-grid",
-            "div.gallery",
-            
-            # Lists
-            "ul.product-list",
-            "div.product-list",
-            "ul.items",
-            "div.items-container",
-            
-            # Common e-commerce patterns
-            "div.products",
-            "ul.products",
-            "div.search-results",
-            "div.collection-products",
-            
-            # Store/restaurant card grids
-            "div[data-testid='store-card']",
-            "div.m9.p0.p1[data-testid='store-card']",
-            "div.store-list",
-            "div.restaurants-list",
-            "li[data-testid='carousel-slide']",
-            "div.l7.al.l9.la.nn",
-            
-            # Uber Eats specific patterns
-            "div.f4.f8.bs.m0.ly",
-            "li.f9.ak.gn.nr",
-            "div.ak.bu",
-            "ol.ak.al.bh.ly.m0.mr",
-        ]
-        
         # First try with predefined selectors
-        for selector in grid_selectors:
-            elements = soup.select(selector)
-            for element in elements:
-                # Find direct children that could be grid items
-                items = element.find_all(["li", "div", "article"], recursive=False)
+        try:
+            for selector in GRID_SELECTORS:
+                elements = selector.select(soup)
+                for element in elements:
+                    if truncated_count >= max_truncations:
+                        return add_truncation_note(soup, truncated_count)
+                    # Find direct children that could be grid items
+                    items = element.find_all(["li", "div", "article"], recursive=False)
                 
-                # If we have more than max_items, truncate
-                if len(items) > max_items:
-                    print(f"Truncating element with selector '{selector}' from {len(items)} to {max_items} items")
-                    # Remove all items after max_items
-                    for item in items[max_items:]:
-                        try:
-                            if not item.decomposed:
-                                item.decompose()
-                        except Exception as e:
-                            print(f"Error removing grid item: {e}")
-                    truncated_count += 1
+                    # If we have more than max_items, truncate
+                    if len(items) > max_items:
+                        print(f"Truncating element with selector '{selector.pattern}' from {len(items)} to {max_items} items")
+                        # Remove all items after max_items
+                        decompose_all(items[max_items:])
+                        truncated_count += 1
+        except Exception as e:
+            print(f"Error processing grid selectors: {e}")
         
         # Handle the specific Uber Eats menu item pattern
-        menu_items = soup.select("li.np.nq.nr.qg.ak.bb.i7.gn") or soup.select("li.np.nq.nr.ak.ns")
-        if menu_items and len(menu_items) > max_items:
-            print(f"Truncating menu items from {len(menu_items)} to {max_items} items")
-            # Find the parent container
-            if menu_items[0].parent:
-                parent_container = menu_items[0].parent
-                # Remove excess items
-                for item in menu_items[max_items:]:
-                    try:
-                        if not item.decomposed:
-                            item.decompose()
-                    except Exception as e:
-                        print(f"Error removing menu item: {e}")
-                truncated_count += 1
+        try:
+            menu_items = soup.select("li.np.nq.nr.qg.ak.bb.i7.gn") or soup.select("li.np.nq.nr.ak.ns")
+            if menu_items and len(menu_items) > max_items:
+                print(f"Truncating menu items from {len(menu_items)} to {max_items} items")
+                # Find the parent container
+                if menu_items[0].parent:
+                    parent_container = menu_items[0].parent
+                    # Remove excess items
+                    decompose_all(menu_items[max_items:])
+                    truncated_count += 1
+        except Exception as e:
+            print(f"Error processing menu items: {e}")
         
         # Special handling for carousel sections
-        carousel_sections = []
+        try:
+            carousel_sections = []
         
-        # Find all section elements that might be carousels
-        for section in soup.find_all("section"):
-            if carousel_count >= max_carousels:
-                break
+            # Find all section elements that might be carousels
+            for section in elements_by_tag["section"]:
+                if carousel_count >= max_carousels:
+                    break
+                if section.decomposed:
+                    continue
             
-            # Look for carousel indicators like navigation buttons or carousel slides
-            carousel_indicators = section.select("button[data-testid='next-arrow-carousel']") or section.select("li[data-testid='carousel-slide']")
-            if carousel_indicators:
-                # Find all carousel slide lists (ul elements with carousel slides)
-                slide_lists = section.select("ul:has(li[data-testid='carousel-slide'])") or section.select("ul.k8.nj.nk.nl.nm.nn.no.ae")
-                if slide_lists and len(slide_lists) > max_items:  # If there are more than max_items carousel sections
-                    carousel_sections.append((section, slide_lists))
-                    carousel_count += 1
-                    print(f"Found carousel section with {len(slide_lists)} lists")
-        
-        # Truncate carousel sections to show only the first max_items
-        for section, slide_lists in carousel_sections:
-            if len(slide_lists) > max_items:
-                print(f"Truncating carousel section from {len(slide_lists)} lists to {max_items} lists")
-                # Remove all slide lists after the first max_items
-                for slide_list in slide_lists[max_items:]:
-                    try:
-                        if not slide_list.decomposed:
-                            slide_list.decompose()
-                    except Exception as e:
-                        print(f"Error removing slide list: {e}")
-                truncated_count += 1
+                # Look for carousel indicators like navigation buttons or carousel slides
+                carousel_indicators = section.select("button[data-testid='next-arrow-carousel']") or section.select("li[data-testid='carousel-slide']")
+                if carousel_indicators:
+                    # Find all carousel slide lists (ul elements with carousel slides)
+                    slide_lists = section.select("ul:has(li[data-testid='carousel-slide'])") or section.select("ul.k8.nj.nk.nl.nm.nn.no.ae")
+                    if slide_lists and len(slide_lists) > max_items:  # If there are more than max_items carousel sections
+                        carousel_sections.append((section, slide_lists))
+                        carousel_count += 1
+                        print(f"Found carousel section with {len(slide_lists)} lists")
+        
+            # Truncate carousel sections to show only the first max_items
+            for section, slide_lists in carousel_sections:
+                if len(slide_lists) > max_items:
+                    print(f"Truncating carousel section from {len(slide_lists)} lists to {max_items} lists")
+                    # Remove all slide lists after the first max_items
+                    decompose_all(slide_lists[max_items:])
+                    truncated_count += 1
+        except Exception as e:
+            print(f"Error processing carousel sections: {e}")
         
         # Handle multiple carousel sections in a page
-        all_carousel_sections = soup.find_all("section")
-        if len(all_carousel_sections) > max_carousels:
-            print(f"Found {len(all_carousel_sections)} carousel sections, truncating to {max_carousels}")
-            for section in all_carousel_sections[max_carousels:]:
-                try:
-                    if not section.decomposed:
-                        section.decompose()
-                except Exception as e:
-                    print(f"Error removing carousel section: {e}")
-            truncated_count += 1
+        try:
+            all_carousel_sections = [section for section in elements_by_tag["section"] if not section.decomposed]
+            if len(all_carousel_sections) > max_carousels:
+                print(f"Found {len(all_carousel_sections)} carousel sections, truncating to {max_carousels}")
+                decompose_all(all_carousel_sections[max_carousels:])
+                truncated_count += 1
+        except Exception as e:
+            print(f"Error truncating carousel sections: {e}")
         
         # Look for any collection of elements with the same data-testid attribute
-        data_testid_values = {}
+        # Check if any data-testid group has more than max_items
         try:
-            for element in soup.find_all(attrs={"data-testid": True}):
-                try:
-                    testid = element.get("data-testid")
-                    if testid and testid not in data_testid_values:
-                        data_testid_values[testid] = []
-                    if testid:
-                        data_testid_values[testid].append(element)
-                except Exception as e:
-                    print(f"Error processing data-testid element: {e}")
-            
-            # Check if any data-testid group has more than max_items
             for testid, elements in data_testid_values.items():
-                if elements and len(elements) > max_items and testid not in ["carousel", "carousel-slide", "rich-text"]:  # Avoid duplicating carousel handling
+                if truncated_count >= max_truncations:
+                    return add_truncation_note(soup, truncated_count)
+                if testid in ["carousel", "carousel-slide", "rich-text"]:  # Avoid duplicating carousel handling
+                    continue
+                elements = [element for element in elements if not element.decomposed]
+                if len(elements) > max_items:
                     print(f"Truncating elements with data-testid='{testid}' from {len(elements)} to {max_items}")
-                    # Remove excess elements
-                    for element in elements[max_items:]:
-                        try:
-                            if element and not element.decomposed:
-                                element.decompose()
-                        except Exception as e:
-                            print(f"Error removing data-testid element: {e}")
+                    # Remove excess elements; the outer try covers any failure
+                    decompose_all(elements[max_items:])
                     truncated_count += 1
         except Exception as e:
             print(f"Error processing data-testid values: {e}")
         
         # Handle repeated UL elements that contain carousel slides
-        carousel_ul_containers = []
-        for container in soup.select("div.l7.al.l9.la.nn") or soup.select("div.av.nb.nc.hn.nd.al.ne.nf"):
-            try:
+        try:
+            carousel_ul_containers = []
+            for container in soup.select("div.l7.al.l9.la.nn") or soup.select("div.av.nb.nc.hn.nd.al.ne.nf"):
                 carousel_uls = container.select("ul.al.f4.cs.bh.no.gl.np") or container.select("ul.k8.nj.nk.nl.nm.nn.no.ae")
                 if carousel_uls and len(carousel_uls) > max_items:
                     carousel_ul_containers.append((container, carousel_uls))
-            except Exception as e:
-                print(f"Error processing carousel UL container: {e}")
-        
-        for container, uls in carousel_ul_containers:
-            if len(uls) > max_items:
-                print(f"Truncating carousel UL container from {len(uls)} ULs to {max_items}")
-                for ul in uls[max_items:]:
-                    try:
-                        if not ul.decomposed:
-                            ul.decompose()
-                    except Exception as e:
-                        print(f"Error removing carousel UL: {e}")
-                truncated_count += 1
+        
+            for container, uls in carousel_ul_containers:
+                if len(uls) > max_items:
+                    print(f"Truncating carousel UL container from {len(uls)} ULs to {max_items}")
+                    decompose_all(uls[max_items:])
+                    truncated_count += 1
+        except Exception as e:
+            print(f"Error processing carousel UL containers: {e}")
         
         # Handle empty placeholder elements
-        empty_li_elements = soup.select("li[style='position: relative; max-width: 95px;']:empty")
-        if empty_li_elements and len(empty_li_elements) > 2:  # Keep fewer for layout purposes
-            print(f"Removing {len(empty_li_elements) - 2} empty placeholder elements")
-            for li in empty_li_elements[2:]:
-                try:
-                    if not li.decomposed:
-                        li.decompose()
-                except Exception as e:
-                    print(f"Error removing empty placeholder: {e}")
-            truncated_count += 1
+        try:
+            empty_li_elements = soup.select("li[style='position: relative; max-width: 95px;']:empty")
+            if empty_li_elements and len(empty_li_elements) > 2:  # Keep fewer for layout purposes
+                print(f"Removing {len(empty_li_elements) - 2} empty placeholder elements")
+                decompose_all(empty_li_elements[2:])
+                truncated_count += 1
+        except Exception as e:
+            print(f"Error removing empty placeholders: {e}")
+        
+        # The remaining passes are optional; skip them once enough has been trimmed
+        if truncated_count >= MAX_TRUNCATIONS:
+            return add_truncation_note(soup, truncated_count)
         
         # Handle promotional banners/cards
-        promo_cards = soup.select("a.ea.bh.bu.af.mu.iv.dk.mv") or soup.select("a[href*='mod=quickView']")
-        if promo_cards and len(promo_cards) > max_items:
-            print(f"Truncating promotional banners from {len(promo_cards)} to {max_items}")
-            for card in promo_cards[max_items:]:
-                try:
-                    if not card.decomposed:
-                        card.decompose()
-                except Exception as e:
-                    print(f"Error removing promo card: {e}")
-            truncated_count += 1
+        try:
+            promo_cards = soup.select("a.ea.bh.bu.af.mu.iv.dk.mv") or soup.select("a[href*='mod=quickView']")
+            if promo_cards and len(promo_cards) > max_items:
+                print(f"Truncating promotional banners from {len(promo_cards)} to {max_items}")
+                decompose_all(promo_cards[max_items:])
+                truncated_count += 1
+        except Exception as e:
+            print(f"Error processing promo cards: {e}")
+        
+        if truncated_count >= MAX_TRUNCATIONS:
+            return add_truncation_note(soup, truncated_count)
         
         # Handle preload link tags
-        preload_links = soup.select("link[rel='preload']")
-        if preload_links and len(preload_links) > 5:  # Keep fewer essential preloads
-            print(f"Truncating preload links from {len(preload_links)} to 5")
-            for link in preload_links[5:]:
-                try:
-                    if not link.decomposed:
-                        link.decompose()
-                except Exception as e:
-                    print(f"Error removing preload link: {e}")
-            truncated_count += 1
+        try:
+            preload_links = soup.select("link[rel='preload']")
+            if preload_links and len(preload_links) > 5:  # Keep fewer essential preloads
+                print(f"Truncating preload links from {len(preload_links)} to 5")
+                decompose_all(preload_links[5:])
+                truncated_count += 1
+        except Exception as e:
+            print(f"Error processing preload links: {e}")
+        
+        if truncated_count >= MAX_TRUNCATIONS:
+            return add_truncation_note(soup, truncated_count)
         
         # Handle script tags with similar sources
-        script_srcs = {}
-        for script in soup.find_all("script", src=True):
-            try:
-                src_pattern = script['src'].split('/')[-1].split('-')[0]  # Group by filename pattern
-                if src_pattern not in script_srcs:
-                    script_srcs[src_pattern] = []
-                script_srcs[src_pattern].append(script)
-            except Exception as e:
-                print(f"Error processing script: {e}")
-        
-        # Keep only a few scripts from each pattern group
-        for pattern, scripts in script_srcs.items():
-            if len(scripts) > 2:  # Keep fewer scripts from each pattern
-                print(f"Truncating script tags with pattern '{pattern}' from {len(scripts)} to 2")
-                for script in scripts[2:]:
-                    try:
-                        if not script.decomposed:
-                            script.decompose()
-                    except Exception as e:
-                        print(f"Error removing script: {e}")
-                    truncated_count += 1
+        try:
+            script_srcs = {}
+            for script in soup.find_all("script", src=True):
+                src_pattern = script['src'].rsplit('/', 1)[-1].split('-', 1)[0]  # Group by filename pattern
+                script_srcs.setdefault(src_pattern, []).append(script)
+        
+            # Keep only a few scripts from each pattern group
+            for pattern, scripts in script_srcs.items():
+                if truncated_count >= max_truncations:
+                    return add_truncation_note(soup, truncated_count)
+                if len(scripts) > 2:  # Keep fewer scripts from each pattern
+                    print(f"Truncating script tags with pattern '{pattern}' from {len(scripts)} to 2")
+                    truncated_count += decompose_all(scripts[2:])
+        except Exception as e:
+            print(f"Error processing script tags: {e}")
+        
+        if truncated_count >= MAX_TRUNCATIONS:
+            return add_truncation_note(soup, truncated_count)
         
         # Detect grid-like structures by looking for patterns
         potential_grids = []
+        try:
         
-        # Find elements that have many similar direct children
-        for tag in ["div", "ul", "section"]:
-            for element in soup.find_all(tag):
-                try:
+            # Find elements that have many similar direct children
+            for tag in ["div", "ul", "section"]:
+                for element in elements_by_tag[tag]:
+                    if element.decomposed:
+                        continue
                     # Skip elements that are too deep in the DOM
-                    if len(list(element.parents)) > 10:
+                    if element_depths[id(element)] > 10:
                         continue
-                    
+                
                     # Get direct children
-                    children = element.find_all(["div", "li", "article"], recursive=False)
-                    
+                    children = [child for child in element.contents if getattr(child, "name", None) in GRID_CHILD_TAGS]
+                
                     # If there are enough children, check if they're similar
                     if len(children) >= max_items + 1:  # At least one more than our max
                         # Check if children have similar structure (class names or tag structure)
-                        class_sets = [set(child.get('class', [])) for child in children if child.get('class')]
-                        
+                        child_classes = [child.get('class') for child in children if child.get('class')]
+                    
                         # If at least 70% of children have classes and they share some common classes
-                        if class_sets and len(class_sets) >= 0.7 * len(children):
-                            # Find common classes across children
-                            common_classes = set.intersection(*class_sets) if class_sets else set()
-                            
-                            # If there are common classes or all children have the same tag
-                            if common_classes or all(child.name == children[0].name for child in children):
+                        if child_classes and len(child_classes) >= 0.7 * len(children):
+                            # All children having the same tag is the common case, so check that first
+                            if len({child.name for child in children}) == 1:
                                 potential_grids.append((element, children))
-                except Exception as e:
-                    print(f"Error detecting grid-like structure: {e}")
-        
-        # Truncate detected potential grids
-        for element, children in potential_grids:
-            if len(children) > max_items:
-                print(f"Detected and truncating grid-like element from {len(children)} to {max_items} items")
-                # Remove all items after max_items
-                for child in children[max_items:]:
-                    try:
-                        if not child.decomposed:
-                            child.decompose()
-                    except Exception as e:
-                        print(f"Error removing grid child: {e}")
-                truncated_count += 1
+                            else:
+                                # A class is common to every classed child iff it is counted once per child
+                                class_counts = Counter(cls for classes in child_classes for cls in set(classes))
+                                if any(count == len(child_classes) for count in class_counts.values()):
+                                    potential_grids.append((element, children))
         
-        # Handle repeated elements with similar structure but different parent tags
-        repeated_elements_by_structure = {}
+            # Truncate detected potential grids
+            for element, children in potential_grids:
+                if truncated_count >= max_truncations:
+                    return add_truncation_note(soup, truncated_count)
+                if len(children) > max_items:
+                    print(f"Detected and truncating grid-like element from {len(children)} to {max_items} items")
+                    # Remove all items after max_items
+                    decompose_all(children[max_items:])
+                    truncated_count += 1
+        except Exception as e:
+            print(f"Error detecting grid-like structures: {e}")
         
-        # Find elements with similar structure based on their tag and class attributes
-        for tag in ["li", "div", "article", "a"]:
-            elements = soup.find_all(tag)
-            for element in elements:
-                try:
-                    # Create a key based on tag name and classes
-                    classes = element.get('class', [])
-                    if classes:
-                        key = f"{tag}:{'.'.join(sorted(classes))}"
-                        if key not in repeated_elements_by_structure:
-                            repeated_elements_by_structure[key] = []
-                        repeated_elements_by_structure[key].append(element)
-                except Exception as e:
-                    print(f"Error processing repeated element: {e}")
+        if truncated_count >= MAX_TRUNCATIONS:
+            return add_truncation_note(soup, truncated_count)
         
-        # Check for groups of similar elements that exceed our threshold
-        for key, elements in repeated_elements_by_structure.items():
-            if len(elements) > max_items:
-                try:
-                    # Check if they share a common parent
-                    parents = [element.parent for element in elements]
-                    parent_counts = {}
-                    for parent in parents:
-                        if parent not in parent_counts:
-                            parent_counts[parent] = 0
-                        parent_counts[parent] += 1
-                    
+        # Handle repeated elements with similar structure but different parent tags,
+        # grouped by tag and class attributes during the initial walk
+        try:
+            repeated_elements_by_structure = {}
+            for tag in ["li", "div", "article", "a"]:
+                for key, elements in structure_groups[tag].items():
+                    elements = [element for element in elements if not element.decomposed]
+                    if elements:
+                        repeated_elements_by_structure[key] = elements
+        
+            # Check for groups of similar elements that exceed our threshold
+            for key, elements in repeated_elements_by_structure.items():
+                if truncated_count >= max_truncations:
+                    return add_truncation_note(soup, truncated_count)
+                if len(elements) > max_items:
+                    # Check if they share a common parent, bucketing elements by parent in one pass.
+                    # Elements removed by an earlier group have no parent left, so they're skipped.
+                    buckets = defaultdict(list)
+                    for element in elements:
+                        if not element.decomposed:
+                            buckets[id(element.parent)].append(element)
+                
                     # If most elements share the same parent, truncate them
-                    for parent, count in parent_counts.items():
-                        if count > max_items:
-                            parent_elements = [e for e in elements if e.parent == parent]
+                    for parent_elements in buckets.values():
+                        if len(parent_elements) > max_items:
                             print(f"Truncating repeated elements with structure '{key}' from {len(parent_elements)} to {max_items}")
-                            for element in parent_elements[max_items:]:
-                                try:
-                                    if not element.decomposed:
-                                        element.decompose()
-                                except Exception as e:
-                                    print(f"Error removing repeated element: {e}")
+                            decompose_all(parent_elements[max_items:])
                             truncated_count += 1
                             break
-                except Exception as e:
-                    print(f"Error processing repeated elements group: {e}")
+        except Exception as e:
+            print(f"Error processing repeated elements: {e}")
         
         # Final fallback: Look for any parent with many similar children based on HTML structure
-        for tag in ["div", "section", "main", "ul"]:
-            for element in soup.find_all(tag):
-                try:
-                    # Skip if we've already processed this element
-                    if element.decomposed or element in [grid[0] for grid in potential_grids]:
-                        continue
+        # Candidate parents were collected during the initial walk
+        try:
+            grid_heads = {id(grid[0]) for grid in potential_grids}
+            for element in fallback_candidates:
+                if truncated_count >= max_truncations:
+                    return add_truncation_note(soup, truncated_count)
+                # Skip if we've already processed this element
+                if element.decomposed or id(element) in grid_heads:
+                    continue
+            
+                # Bucket direct children by tag in a single pass over .contents
+                buckets = {"div": [], "li": [], "article": [], "a": []}
+                for child in element.contents:
+                    bucket = buckets.get(getattr(child, "name", None))
+                    if bucket is not None:
+                        bucket.append(child)
+            
+                # Get all children with the same tag
+                for child_tag, children in buckets.items():
+                
+                    # If enough similar children, check if they look like a grid
+                    if len(children) > max_items:
+                        # Check if they have similar HTML structure (size). Counting descendant
+                        # nodes walks each subtree without serializing it to a string.
+                        html_sizes = [sum(1 for _ in child.descendants) for child in children]
                     
-                    # Get all children with the same tag
-                    for child_tag in ["div", "li", "article", "a"]:
-                        children = element.find_all(child_tag, recursive=False)
-                        
-                        # If enough similar children, check if they look like a grid
-                        if len(children) > max_items:
-                            # Check if they have similar HTML structure (length)
-                            html_lengths = [len(str(child)) for child in children]
-                            avg_length = sum(html_lengths) / len(html_lengths)
-                            
-                            # If the HTML lengths are similar (within 30% of average)
-                            similar_count = sum(1 for length in html_lengths if 0.7 * avg_length <= length <= 1.3 * avg_length)
-                            if similar_count >= 0.8 * len(children):
-                                print(f"Truncating similar HTML structure elements from {len(children)} to {max_items}")
-                                # Remove excess elements
-                                for child in children[max_items:]:
-                                    try:
-                                        if not child.decomposed:
-                                            child.decompose()
-                                    except Exception as e:
-                                        print(f"Error removing similar HTML structure element: {e}")
-                                    truncated_count += 1
-                                break  # Only process one child tag per parent
-                except Exception as e:
-                    print(f"Error processing parent with similar children: {e}")
+                        # If the HTML sizes are similar (within 30% of average)
+                        if len(html_sizes) >= VECTORIZE_MIN_CHILDREN:
+                            # Large grids (infinite-scroll feeds, full menus) are compared in numpy
+                            sizes = np.fromiter(html_sizes, dtype=np.int64, count=len(html_sizes))
+                            avg_size = sizes.mean()
+                            similar_count = int(((sizes >= 0.7 * avg_size) & (sizes <= 1.3 * avg_size)).sum())
+                        else:
+                            avg_size = sum(html_sizes) / len(html_sizes)
+                            similar_count = len(html_sizes)
+                            for size in html_sizes:
+                                if not 0.7 * avg_size <= size <= 1.3 * avg_size:
+                                    similar_count -= 1
+                                    # Too many outliers to pass the 80% check below, so stop early
+                                    if similar_count < 0.8 * len(children):
+                                        break
+                        if similar_count >= 0.8 * len(children):
+                            print(f"Truncating similar HTML structure elements from {len(children)} to {max_items}")
+                            # Remove excess elements
+                            decompose_all(children[max_items:])
+                            truncated_count += len(children) - max_items
+                            break  # Only process one child tag per parent
+        except Exception as e:
+            print(f"Error processing parents with similar children: {e}")
         
         # Specific handling for Uber Eats menu tabs
         try:
@@ -702,39 +889,53 @@ def truncate_repeated_elements(soup, max_items=5, max_carousels=2, max_menu_sect
                 menu_tabs = menu_tabs_container.find_all("button", role="tab")
                 if menu_tabs and len(menu_tabs) > max_menu_sections:
                     print(f"Truncating menu tabs from {len(menu_tabs)} to {max_menu_sections}")
-                    for tab in menu_tabs[max_menu_sections:]:
-                        try:
-                            if tab and not tab.decomposed:
-                                tab.decompose()
-                        except Exception as e:
-                            print(f"Error removing menu tab: {e}")
+                    decompose_all(menu_tabs[max_menu_sections:])
                     truncated_count += 1
         except Exception as e:
             print(f"Error processing menu tabs container: {e}")
         
         # Add a note about truncation if we truncated anything
-        if truncated_count > 0:
-            try:
-                truncation_note = soup.new_tag("div")
-                truncation_note["style"] = "padding: 10px; background-color: #f8f9fa; margin: 10px 0; border-radius: 4px;"
-                truncation_note.string = f"Note: This page has been truncated to show only essential content. {truncated_count} sections were simplified."
-                
-                # Try to insert at the beginning of the body or as first child of a main container
-                body = soup.find("body")
-                if body:
-                    body.insert(0, truncation_note)
-                else:
-                    main_container = soup.find("div", class_="gh") or soup.find("main") or soup.find("div", id="main-content")
-                    if main_container:
-                        main_container.insert(0, truncation_note)
-            except Exception as e:
-                print(f"Error adding truncation note: {e}")
-        
-        return truncated_count
+        return add_truncation_note(soup, truncated_count)
     except Exception as e:
         print(f"Error in truncate_repeated_elements: {e}")
         return 0
 
+def decompose_all(elements):
+    """
+    Decomposes every element that is still in the tree and returns how many were removed.
+    Elements can be nested in one another, so each is checked as it's reached.
+    """
+    removed = 0
+    for element in elements:
+        if not element.decomposed:
+            element.decompose()
+            removed += 1
+    return removed
+
+def add_truncation_note(soup, truncated_count):
+    """
+    Inserts a note at the top of the page describing how many sections were truncated.
+    Returns the truncated count so callers can return it directly.
+    """
+    if truncated_count > 0:
+        try:
+            truncation_note = soup.new_tag("div")
+            truncation_note["style"] = "padding: 10px; background-color: #f8f9fa; margin: 10px 0; border-radius: 4px;"
+            truncation_note.string = f"Note: This page has been truncated to show only essential content. {truncated_count} sections were simplified."
+            
+            # Try to insert at the beginning of the body or as first child of a main container
+            body = soup.find("body")
+            if body:
+                body.insert(0, truncation_note)
+            else:
+                main_container = soup.find("div", class_="gh") or soup.find("main") or soup.find("div", id="main-content")
+                if main_container:
+                    main_container.insert(0, truncation_note)
+        except Exception as e:
+            print(f"Error adding truncation note: {e}")
+    
+    return truncated_count
+
 def download_javascript_asset(asset_url, base_url, save_dir, asset_type="js"):
     """
     Downloads JavaScript assets and stores them in the proper directory structure.
@@ -777,40 +978,33 @@ def download_javascript_asset(asset_url, base_url, save_dir, asset_type="js"):
             # Absolute URL - create a directory structure that mirrors the URL path
             path_parts = parsed_url.path.strip('/').split('/')
             
-            if len(path_parts) > 1:
-                # Use the directory structure from the URL
-                relative_dir = os.path.join(*path_parts[:-1])
-                filename = path_parts[-1]
-            else:
-                # If there's just a filename with no directories
-                relative_dir = ""
-                filename = path_parts[0] if path_parts else "script.js"
+            # Use the directory structure from the URL (empty if there's just a filename)
+            relative_dir = '/'.join(path_parts[:-1])
+            filename = path_parts[-1] if path_parts else "script.js"
             
             # If filename has no extension, add .js
             if not os.path.splitext(filename)[1]:
                 filename += ".js"
-                
-            # Create the full directory path
-            full_dir = os.path.join(save_dir, relative_dir)
-            os.makedirs(full_dir, exist_ok=True)
             
-            # Full path to save the file
-            file_path = os.path.join(full_dir, filename)
+            # Full path to save the file, built in one step
+            file_path = f"{save_dir}/{relative_dir}/{filename}" if relative_dir else f"{save_dir}/{filename}"
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
         
         # If the file already exists, return the path
         if os.path.exists(file_path):
             print(f"JavaScript file already exists: {file_path}")
             return original_url, file_path
 
-        # Download the JavaScript file
-        response = requests.get(asset_url, timeout=10)
-        if response.status_code != 200:
-            print(f"Skipping JavaScript {asset_url} because of status code {response.status_code}")
-            return None, None
+        # Download the JavaScript file, streaming the decompressed body straight to disk
+        with SESSION.get(asset_url, timeout=10, stream=True) as response:
+            if response.status_code != 200:
+                print(f"Skipping JavaScript {asset_url} because of status code {response.status_code}")
+                return None, None
 
-        # Save the file
-        with open(file_path, 'wb') as f:
-            f.write(response.content)
+            # Save the file
+            response.raw.decode_content = True
+            with open(file_path, 'wb') as f:
+                shutil.copyfileobj(response.raw, f)
         
         print(f"Downloaded JavaScript: {original_url} to {file_path}")
         return original_url, file_path
@@ -831,7 +1025,6 @@ def download_all_javascript_from_page(html_content, page_url, output_dir):
     Returns:
         list: List of tuples (original_url, file_path) for all downloaded JavaScript files
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
     base_url = '/'.join(page_url.split('/')[:3])
     
     # Create the output directory if it doesn't exist
@@ -840,21 +1033,21 @@ def download_all_javascript_from_page(html_content, page_url, output_dir):
     # List to store results
     downloaded_files = []
     
-    # Process script tags with src attribute
-    for script in soup.find_all('script', src=True):
-        src = script.get('src')
-        if src:
-            asset_url, file_path = download_javascript_asset(src, base_url, output_dir)
-            if file_path:
-                downloaded_files.append((asset_url, file_path))
+    # One parse serves both the external references and the inline scripts below
+    soup = BeautifulSoup(html_content, 'lxml')
+    script_srcs = [script['src'] for script in soup.find_all('script', src=True) if script['src']]
+    preload_hrefs = [link['href'] for link in soup.find_all('link', attrs={'rel': 'preload', 'as': 'script'})
+                     if link.get('href')]
     
-    # Process link tags with rel="preload" and as="script"
-    for link in soup.find_all('link', attrs={'rel': 'preload', 'as': 'script'}):
-        href = link.get('href')
-        if href:
-            asset_url, file_path = download_javascript_asset(href, base_url, output_dir)
-            if file_path:
-                downloaded_files.append((asset_url, file_path))
+    # Process script tags with src attribute, then link tags with rel="preload" and as="script".
+    # The same bundle is often both preloaded and loaded, so each URL is only fetched once.
+    seen_urls = set()
+    unique_urls = [u for u in script_srcs + preload_hrefs
+                   if not (u in seen_urls or seen_urls.add(u))]
+    for src in unique_urls:
+        asset_url, file_path = download_javascript_asset(src, base_url, output_dir)
+        if file_path:
+            downloaded_files.append((asset_url, file_path))
     
     # Process inline scripts
     inline_scripts_dir = os.path.join(output_dir, "inline_scripts")
@@ -873,6 +1066,9 @@ def download_all_javascript_from_page(html_content, page_url, output_dir):
         # Skip empty scripts
         if not script_content:
             continue
+        
+        # Encode once; the bytes are shared between the content hash and the file write
+        script_bytes = script_content.encode('utf-8')
             
         # Determine filename based on script attributes
         if script_id:
@@ -880,12 +1076,12 @@ def download_all_javascript_from_page(html_content, page_url, output_dir):
             filename = f"{script_id.replace('/', '_').replace(':', '_')}.js"
         elif script_type in ['module', 'importmap', 'application/json', 'application/ld+json']:
             # Use type for specialized scripts
-            content_hash = hashlib.md5(script_content.encode('utf-8')).hexdigest()[:8]
+            content_hash = hash_hex(script_bytes)[:8]
             script_type_clean = script_type.replace('/', '_').replace('application_', '')
             filename = f"inline_{script_type_clean}_{content_hash}.js"
         else:
             # Generic inline script
-            content_hash = hashlib.md5(script_content.encode('utf-8')).hexdigest()[:8]
+            content_hash = hash_hex(script_bytes)[:8]
             filename = f"inline_script_{content_hash}.js"
         
         # Save the inline script
@@ -920,8 +1116,8 @@ def download_all_javascript_from_page(html_content, page_url, output_dir):
                 file_path = os.path.join(inline_scripts_dir, filename)
         
         # Save as regular script
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(script_content)
+        with open(file_path, 'wb') as f:
+            f.write(script_bytes)
         
         downloaded_files.append((f"inline_script_{script_id or 'unnamed'}", file_path))
     
@@ -1,9 +1,17 @@
 import dotenv
 import anthropic
+import httpx
+import functools
+import hashlib
+import asyncio
+import aiofiles
 from data_models import Site, Page
 import os
-import json
+import orjson
 import re
+import time
+import collections
+import contextlib
 
 SYSTEM_PROMPT = """You are an intelligent web developer that specializes in producing websites from top tier design companies. 
 Do your absolute best to create the page or else you will be fired.
@@ -43,39 +51,320 @@ relative links on this page with the corresponding absolute link.
 
 Return only the final HTML output formatted in ```html and ``` tags. Do not return any other text in your response."""
 
+# Output directories, resolved once at import. The cloned site holds every stage's
+# pages; raw Anthropic API responses are saved for testing/debugging
+CLONED_SITE_DIR = os.path.join(os.getcwd(), "cloned_site")
+ANTHROPIC_DIR = os.path.join(os.getcwd(), "anthropic")
+
+MODEL = "claude-3-7-sonnet-20250219"
+
+# Opt-in on-disk cache of model responses shared by every workflow, see read_cached_message
+LLM_CACHE_ENABLED = os.environ.get("YUTORI_LLM_CACHE") == "1"
+LLM_CACHE_DIR = os.path.join(ANTHROPIC_DIR, "cache")
+
+# Maximum number of concurrent API requests, to stay under the rate limit. Override with ANTHROPIC_CONCURRENCY
+API_CONCURRENCY = int(os.environ.get("ANTHROPIC_CONCURRENCY", 8))
+
+# Seconds between status checks while a message batch is processing
+BATCH_POLL_SECONDS = 30
+
+# The interactions stage can also dump the parsed response to v2/<page>_data.json.
+# Nothing in the pipeline reads it back, so it's only written when SAVE_JSON_SIDECAR=1
+SAVE_JSON_SIDECAR = os.environ.get("SAVE_JSON_SIDECAR") == "1"
+
+# Raw responses (and, in the enhanced injection workflow, the generated JavaScript)
+# are only dumped when YUTORI_DEBUG=1
+DEBUG = os.environ.get("YUTORI_DEBUG") == "1"
+
+# Consecutive rate-limit or server errors that trip the circuit breaker, and how
+# long calls then fail fast before one is let through again
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN_SECONDS = 30
+
+# Requests and input tokens per minute to stay under, matching the account's Anthropic
+# rate limits. Set ANTHROPIC_RPM / ANTHROPIC_TPM; 0 (the default) leaves that limit off
+API_RPM = int(os.environ.get("ANTHROPIC_RPM", 0))
+API_TPM = int(os.environ.get("ANTHROPIC_TPM", 0))
+
+# Slashes, backslashes, equals signs and other problematic filename characters
+# are all replaced with underscores in a single translate pass
+_BAD_CHARS = '/\\?%*:|"<>='
+_SANITIZE_TABLE = str.maketrans(_BAD_CHARS, '_' * len(_BAD_CHARS))
+
+# The client is created once per process so .env is read once and every stage
+# (and every workflow run, clone or enhanced injection) reuses the same pooled
+# HTTP/2 connections. Rate limits and server errors are retried with backoff.
+@functools.cache
+def get_client():
+    return anthropic.AsyncAnthropic(
+        api_key=dotenv.get_key(".env", "ANTHROPIC_API_KEY"),
+        max_retries=5,
+        http_client=anthropic.DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32)
+        )
+    )
+
+class CircuitBreaker:
+    """
+    Wraps each Anthropic call through guard(). The SDK already retries a failed
+    request with backoff; once several requests in a row still end in a 429,
+    5xx or connection error the breaker opens, and calls fail immediately for
+    the cooldown instead of piling more retries onto an API that is already
+    struggling. After the cooldown a single call goes out as a probe while the
+    rest keep failing fast: if it succeeds the breaker closes, and if it fails
+    the breaker opens again.
+    """
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    @contextlib.asynccontextmanager
+    async def guard(self):
+        probe = False
+        if self.failures >= self.threshold:
+            remaining = self.open_until - time.monotonic()
+            if remaining > 0:
+                raise RuntimeError(f"Anthropic circuit breaker open for another {remaining:.0f}s")
+            if self.probing:
+                raise RuntimeError("Anthropic circuit breaker waiting on a probe request")
+            self.probing = probe = True
+        try:
+            yield
+        except (anthropic.RateLimitError, anthropic.InternalServerError, anthropic.APIConnectionError):
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.open_until = time.monotonic() + self.cooldown
+                print(f"{self.failures} Anthropic errors in a row, failing fast for {self.cooldown}s")
+            raise
+        else:
+            self.failures = 0
+        finally:
+            if probe:
+                self.probing = False
+
+class RateLimiter:
+    """
+    Keeps a sliding one-minute window of sent requests and their estimated
+    input tokens. acquire() waits until another request fits under both
+    limits, so bursts are spread out instead of being answered with 429s.
+    A request bigger than the whole token budget goes out once the window
+    is empty.
+    """
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.sent = collections.deque()
+        self.tokens = 0
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, tokens: int):
+        if self.rpm or self.tpm:
+            while True:
+                now = time.monotonic()
+                while self.sent and now - self.sent[0][0] >= 60:
+                    self.tokens -= self.sent.popleft()[1]
+                fits_requests = not self.rpm or len(self.sent) < self.rpm
+                fits_tokens = not self.tpm or not self.sent or self.tokens + tokens <= self.tpm
+                if fits_requests and fits_tokens:
+                    break
+                # Nothing frees up until the oldest request leaves the window
+                await asyncio.sleep(60 - (now - self.sent[0][0]))
+            self.sent.append((now, tokens))
+            self.tokens += tokens
+        yield
+
+# Rough input token count for a request: about four characters per token of
+# text, and a flat allowance for each image
+def estimate_input_tokens(params: dict) -> int:
+    blocks = params["system"] if isinstance(params["system"], list) else [{"type": "text", "text": params["system"]}]
+    for message in params["messages"]:
+        blocks = blocks + (message["content"] if isinstance(message["content"], list) else [{"type": "text", "text": message["content"]}])
+    return sum(len(block["text"]) // 4 if block["type"] == "text" else 1600 for block in blocks)
+
+# Shared by every workflow so a struggling API is seen by all of them
+api_breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN_SECONDS)
+rate_limiter = RateLimiter(API_RPM, API_TPM)
+
+# Request parameters shared by streamed and batched calls
+def message_params(prompt: str, max_tokens: int):
+    return {
+        "model": MODEL,
+        "max_tokens": max_tokens,
+        "temperature": 0,
+        "system": SYSTEM_PROMPT,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    }
+                ]
+            }
+        ]
+    }
+
+# Requests run at temperature 0, so with YUTORI_LLM_CACHE=1 responses are cached
+# on disk by a hash of the full request params and reused on reruns
+def llm_cache_path(params: dict) -> str:
+    key = hashlib.blake2b(orjson.dumps(params, option=orjson.OPT_SORT_KEYS), digest_size=20).hexdigest()
+    return os.path.join(LLM_CACHE_DIR, f"{key}.json")
+
+# Returns the cached response for these params, or None when caching is off or there is no entry
+async def read_cached_message(params: dict):
+    if not LLM_CACHE_ENABLED:
+        return None
+    cache_path = llm_cache_path(params)
+    if not os.path.exists(cache_path):
+        return None
+    print(f"Using cached response {os.path.basename(cache_path)}")
+    async with aiofiles.open(cache_path, "r", encoding="utf-8") as f:
+        return anthropic.types.Message.model_validate_json(await f.read())
+
+# Saves a response for reuse on the next run when caching is on
+async def write_cached_message(params: dict, message):
+    if not LLM_CACHE_ENABLED:
+        return
+    async with aiofiles.open(llm_cache_path(params), "w", encoding="utf-8") as f:
+        await f.write(message.model_dump_json())
+
+# Returns the final message for a single-prompt request, streamed since the
+# outputs are long, or sent through the stage's MessageBatch when there is one.
+async def stream_message(client, semaphore: asyncio.Semaphore, prompt: str, max_tokens: int, batch=None):
+    params = message_params(prompt, max_tokens)
+    message = await read_cached_message(params)
+    if message is not None:
+        return message
+
+    if batch is not None:
+        message = await batch.submit(params)
+    else:
+        async with semaphore, api_breaker.guard(), rate_limiter.acquire(estimate_input_tokens(params)), client.messages.stream(**params) as stream:
+            # Let the SDK accumulate the streamed events into the final message
+            message = await stream.get_final_message()
+
+    await write_cached_message(params, message)
+    return message
+
+class MessageBatch:
+    """
+    Sends one request per page of a stage through the Message Batches API.
+    The batch is submitted once every page has either queued its request or
+    finished without one (a cache hit or an earlier error), then polled until
+    it ends and each result is handed back to the page that asked for it.
+    """
+    def __init__(self, client, expected: int):
+        self.client = client
+        self.expected = expected
+        self.finished = 0
+        self.requests = []
+        self.futures = {}
+        self.task = None
+
+    async def submit(self, params):
+        custom_id = f"page-{len(self.requests)}"
+        future = asyncio.get_running_loop().create_future()
+        self.requests.append({"custom_id": custom_id, "params": params})
+        self.futures[custom_id] = future
+        self.send_when_ready()
+        return await future
+
+    # Called as each page's stage function returns or raises
+    def page_finished(self):
+        self.finished += 1
+        self.send_when_ready()
+
+    def send_when_ready(self):
+        if self.task is None and self.requests and len(self.requests) + self.finished >= self.expected:
+            self.task = asyncio.ensure_future(self.send())
+
+    async def send(self):
+        try:
+            batch = await self.client.messages.batches.create(requests=self.requests)
+            print(f"Submitted message batch {batch.id} with {len(self.requests)} requests")
+            while batch.processing_status != "ended":
+                await asyncio.sleep(BATCH_POLL_SECONDS)
+                batch = await self.client.messages.batches.retrieve(batch.id)
+
+            async for entry in await self.client.messages.batches.results(batch.id):
+                future = self.futures.get(entry.custom_id)
+                if future is None or future.done():
+                    continue
+                if entry.result.type == "succeeded":
+                    future.set_result(entry.result.message)
+                else:
+                    future.set_exception(RuntimeError(f"Batch request {entry.custom_id} {entry.result.type}"))
+        except Exception as e:
+            print(f"Error running message batch: {e}")
+            for future in self.futures.values():
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            for custom_id, future in self.futures.items():
+                if not future.done():
+                    future.set_exception(RuntimeError(f"Batch request {custom_id} missing from results"))
+
+# Runs a stage's coroutine for every page concurrently. With a batch, each page
+# is reported as finished so the batch never waits on a page that won't submit.
+async def gather_stage(coroutines, batch=None):
+    async def run(coroutine):
+        try:
+            return await coroutine
+        finally:
+            if batch is not None:
+                batch.page_finished()
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines), return_exceptions=True)
+
+# A stage only uses the Batches API when asked to and when it has more than one page
+def stage_batch(client, stage_pages, use_batch_api: bool):
+    if use_batch_api and len(stage_pages) > 1:
+        return MessageBatch(client, len(stage_pages))
+    return None
+
 # Helper function to sanitize filenames
 def sanitize_filename(filename):
-    # Replace slashes, backslashes, and other problematic characters with underscores
-    # Also remove any characters that aren't alphanumeric, underscore, hyphen, or period
-    sanitized = re.sub(r'[/\\?%*:|"<>]', '_', filename)
-    # Replace any equals signs with underscores
-    sanitized = sanitized.replace('=', '_')
-    return sanitized
-
-def clone_workflow(site: Site):
+    return filename.translate(_SANITIZE_TABLE)
+
+# Matches the first ```html fenced block in a model response
+_HTML_BLOCK_RE = re.compile(r"```html(.*?)```", re.DOTALL)
+
+# Returns the contents of the first ```html block, or None if the response has none
+def extract_html_block(output):
+    match = _HTML_BLOCK_RE.search(output)
+    return match.group(1) if match else None
+
+async def clone_workflow(site: Site, use_batch_api: bool = False):
     print("Cloning workflow started")
 
     try:
-        client = anthropic.Anthropic(
-            api_key=dotenv.get_key(".env", "ANTHROPIC_API_KEY")
-        )
+        client = get_client()
+        # Pages are independent within a stage, so each stage runs them concurrently
+        semaphore = asyncio.Semaphore(API_CONCURRENCY)
 
         pages = site.get_pages()
 
         # The cloned site will store the pages of each page
-        cloned_site_dir = os.path.join(os.getcwd(), "cloned_site")
+        cloned_site_dir = CLONED_SITE_DIR
         os.makedirs(cloned_site_dir, exist_ok=True)
         
-        # Create all necessary directories
+        # Create all necessary directories once; the stage functions assume they exist
         v1_dir = os.path.join(cloned_site_dir, "v1")
         v2_dir = os.path.join(cloned_site_dir, "v2")
         v3_dir = os.path.join(cloned_site_dir, "v3")
         final_dir = os.path.join(cloned_site_dir, "final")
         debug_dir = os.path.join(cloned_site_dir, "debug")
-        anthropic_dir = os.path.join(os.getcwd(), "anthropic")
         
-        for directory in [v1_dir, v2_dir, v3_dir, final_dir, debug_dir, anthropic_dir]:
+        for directory in [v1_dir, v2_dir, v3_dir, final_dir, debug_dir]:
             os.makedirs(directory, exist_ok=True)
+        if DEBUG:
+            os.makedirs(ANTHROPIC_DIR, exist_ok=True)
+        if LLM_CACHE_ENABLED:
+            os.makedirs(LLM_CACHE_DIR, exist_ok=True)
         
         # Initialize the construction dictionary for each page
         for page in pages:
@@ -92,14 +381,17 @@ def clone_workflow(site: Site):
         # site is actually extremely accurate. 
 
         print("Initializing HTML")
-        for page in pages:
-            try:
-                page_html_path = initialize_html(client, page, cloned_site_dir)
-                site.construction[page.url]['v1'] = page_html_path
-            except Exception as e:
-                print(f"Error initializing HTML for page {page.url}: {e}")
+        batch = stage_batch(client, pages, use_batch_api)
+        results = await gather_stage(
+            (initialize_html(client, page, cloned_site_dir, semaphore, batch) for page in pages),
+            batch
+        )
+        for page, result in zip(pages, results):
+            if isinstance(result, Exception):
+                print(f"Error initializing HTML for page {page.url}: {result}")
                 # Continue with next page
                 continue
+            site.construction[page.url]['v1'] = result
 
         # Then, we include the assets of the page, allowing the
         # LLM to ensure the assets in the HTML link to the correct static asset.
@@ -113,50 +405,54 @@ def clone_workflow(site: Site):
         # that we've recorded. 
 
         print("Implementing interactions")
-        for page in pages:
-            try:
-                # Skip pages that failed in the HTML initialization step
-                if page.url not in site.construction or 'v1' not in site.construction[page.url]:
-                    print(f"Skipping interactions for page {page.url} due to previous errors")
-                    continue
-                    
-                html_path, functionality = implement_interactions(client, site, page, cloned_site_dir)
-                site.construction[page.url]['v2'] = html_path
-                site.construction[page.url]['functionality'] = functionality
-            except Exception as e:
-                print(f"Error implementing interactions for page {page.url}: {e}")
+        # Skip pages that failed in the HTML initialization step
+        stage_pages = pages_ready_for(site, pages, 'v1', "interactions")
+        batch = stage_batch(client, stage_pages, use_batch_api)
+        results = await gather_stage(
+            (implement_interactions(client, site, page, cloned_site_dir, semaphore, batch) for page in stage_pages),
+            batch
+        )
+        for page, result in zip(stage_pages, results):
+            if isinstance(result, Exception):
+                print(f"Error implementing interactions for page {page.url}: {result}")
                 # Continue with next page
                 continue
+            html_path, functionality = result
+            site.construction[page.url]['v2'] = html_path
+            site.construction[page.url]['functionality'] = functionality
 
         print("Implementing functionality")
-        for page in pages:
-            try:
-                # Skip pages that failed in previous steps
-                if page.url not in site.construction or 'v2' not in site.construction[page.url]:
-                    print(f"Skipping functionality for page {page.url} due to previous errors")
-                    continue
-                    
-                html_path = implement_functionality(client, site, page, cloned_site_dir)
-                site.construction[page.url]['v3'] = html_path
-            except Exception as e:
-                print(f"Error implementing functionality for page {page.url}: {e}")
+        # Skip pages that failed in previous steps
+        stage_pages = pages_ready_for(site, pages, 'v2', "functionality")
+        batch = stage_batch(client, stage_pages, use_batch_api)
+        results = await gather_stage(
+            (implement_functionality(client, site, page, cloned_site_dir, semaphore, batch) for page in stage_pages),
+            batch
+        )
+        for page, result in zip(stage_pages, results):
+            if isinstance(result, Exception):
+                print(f"Error implementing functionality for page {page.url}: {result}")
                 # Continue with next page
                 continue
+            # The HTML is kept alongside the path so linking doesn't read it back from disk
+            site.construction[page.url]['v3'], site.construction[page.url]['v3_html'] = result
 
         print("Linking pages")
-        for page in pages:
-            try:
-                # Skip pages that failed in previous steps
-                if page.url not in site.construction or 'v3' not in site.construction[page.url]:
-                    print(f"Skipping linking for page {page.url} due to previous errors")
-                    continue
-                    
-                html_path = link_pages(client, site, page, cloned_site_dir)
-                site.construction[page.url]['v4'] = html_path
-            except Exception as e:
-                print(f"Error linking pages for page {page.url}: {e}")
+        # Skip pages that failed in previous steps
+        stage_pages = pages_ready_for(site, pages, 'v3', "linking")
+        # The v3 directory doesn't change during linking, so list it once for every page
+        available_pages_str = list_available_pages(cloned_site_dir)
+        batch = stage_batch(client, stage_pages, use_batch_api)
+        results = await gather_stage(
+            (link_pages(client, site, page, cloned_site_dir, available_pages_str, semaphore, batch) for page in stage_pages),
+            batch
+        )
+        for page, result in zip(stage_pages, results):
+            if isinstance(result, Exception):
+                print(f"Error linking pages for page {page.url}: {result}")
                 # Continue with next page
                 continue
+            site.construction[page.url]['v4'] = result
 
         # Finally, we link the pages together using the model to input the URLS, connecting 
         # to other pages
@@ -168,11 +464,32 @@ def clone_workflow(site: Site):
         # Return the site with whatever progress was made
         return site
 
-def link_pages(client, site: Site, page: Page, directory: str):
-    html_path = site.construction[page.url]['v3']
-
-    with open(html_path, "r") as f:
-        html = f.read()
+# Returns the pages that completed the previous stage, skipping the ones that failed
+def pages_ready_for(site: Site, pages, previous_version: str, stage: str):
+    ready = []
+    for page in pages:
+        if page.url not in site.construction or previous_version not in site.construction[page.url]:
+            print(f"Skipping {stage} for page {page.url} due to previous errors")
+            continue
+        ready.append(page)
+    return ready
+
+# Lists the HTML files in the v3 directory to provide as context for linking
+def list_available_pages(directory: str):
+    v3_directory = os.path.join(directory, "v3")
+    if not os.path.exists(v3_directory):
+        return ""
+    with os.scandir(v3_directory) as entries:
+        return "\n".join(entry.name for entry in entries if entry.name.endswith(".html"))
+
+async def link_pages(client, site: Site, page: Page, directory: str, available_pages_str: str, semaphore: asyncio.Semaphore, batch=None):
+    # The functionality stage hands over its HTML in memory; only fall back
+    # to the v3 file if it isn't there
+    v3_html = site.construction[page.url].get('v3_html')
+    if v3_html is None:
+        async with aiofiles.open(site.construction[page.url]['v3'], "r") as f:
+            v3_html = await f.read()
+    html = v3_html
 
     page_name = page.dir
     # Sanitize page name for use in filenames
@@ -181,22 +498,6 @@ def link_pages(client, site: Site, page: Page, directory: str):
 
     internal_links = page.get_internal_links()
 
-    # Get a list of all HTML files in the v3 directory to provide as context for linking
-    v3_directory = os.path.join(directory, "v3")
-    available_pages = []
-    
-    if os.path.exists(v3_directory):
-        for filename in os.listdir(v3_directory):
-            if filename.endswith(".html"):
-                # Add the filename to the list of available pages
-                available_pages.append(filename)
-    
-    available_pages_str = "\n".join(available_pages)
-    
-    # Create the final directory if it doesn't exist
-    final_directory = os.path.join(directory, "final")
-    os.makedirs(final_directory, exist_ok=True)
-    
     # Prepare context about available pages for the LLM
     linking_context = f"""
 Available HTML files in the cloned site:
@@ -206,124 +507,58 @@ Internal links found on this page:
 {internal_links}
 """
 
-    # Create the streaming request
-    with client.messages.stream(
-        model="claude-3-7-sonnet-20250219",
-        max_tokens=40000,
-        temperature=0,
-        system=SYSTEM_PROMPT,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"{LINKING_PROMPT}\n\n{html}\n\n{linking_context}"
-                    }
-                ]
-            }
-        ]
-    ) as stream:
-        # Initialize variables to collect the full response
-        message = None
-        full_response_text = ""
-        
-        # Process each event in the stream
-        for event in stream:
-            if event.type == "message_start":
-                message = event.message
-            elif event.type == "content_block_start":
-                current_block = event.content_block
-            elif event.type == "content_block_delta":
-                if event.delta.text:
-                    full_response_text += event.delta.text
-            elif event.type == "message_delta":
-                if hasattr(event.delta, "usage"):
-                    message.usage = event.delta.usage
-            elif event.type == "message_stop":
-                # Stream is complete
-                pass
+    # Send the request (or reuse a cached response)
+    message = await stream_message(client, semaphore, f"{LINKING_PROMPT}\n\n{html}\n\n{linking_context}", 40000, batch)
+    full_response_text = "".join(block.text for block in message.content if block.type == "text")
     
     try:
         # Use the collected full response text
         output = full_response_text
         
         # Check if the response contains HTML code blocks
-        if "```html" in output and "```" in output.split("```html", 1)[1]:
-            html = output.split("```html")[1].split("```")[0]
-        else:
+        html = extract_html_block(output)
+        if html is None:
             # If no HTML code blocks found, save the raw response for debugging
             debug_path = os.path.join(directory, "debug", f"{safe_page_name}_linking_raw_response.txt")
-            with open(debug_path, "w", encoding="utf-8") as f:
-                f.write(output)
+            async with aiofiles.open(debug_path, "w", encoding="utf-8") as f:
+                await f.write(output)
             print(f"Warning: No HTML code blocks found in linking response for page {page.url}")
             # Use the raw output as HTML (may not be ideal but prevents failure)
             html = output
     except (IndexError, AttributeError) as e:
         print(f"Error extracting HTML from linking response for page {page.url}: {e}")
         # Return original HTML as fallback
-        with open(site.construction[page.url]['v3'], "r") as f:
-            html = f.read()
+        html = v3_html
 
-    with open(html_path, "w", encoding="utf-8") as f:
-        f.write(html)
+    async with aiofiles.open(html_path, "w", encoding="utf-8") as f:
+        await f.write(html)
 
     return html_path
 
-def implement_functionality(client, site: Site, page: Page, directory: str):
+# Returns the path to the v3 HTML file and the HTML itself
+async def implement_functionality(client, site: Site, page: Page, directory: str, semaphore: asyncio.Semaphore, batch=None):
     if page.url in site.construction and 'functionality' in site.construction[page.url]:
         functionality = site.construction[page.url]['functionality']
     else:
         raise ValueError(f"Functionality not found for page {page.url}")
     
-    functionality_input = ""
-    for functionality in functionality:
-        functionality_input += f"Function name: {functionality['function_name']}\n"
-        functionality_input += f"{functionality['description']}\n"
-        functionality_input += f"Element selector: {functionality['element_selector']}\n"
-        functionality_input += f"DOM path: {functionality['dom_path']}\n"
+    functionality_parts = []
+    for function in functionality:
+        functionality_parts.append(
+            f"Function name: {function['function_name']}\n"
+            f"{function['description']}\n"
+            f"Element selector: {function['element_selector']}\n"
+            f"DOM path: {function['dom_path']}\n"
+        )
+    functionality_input = "".join(functionality_parts)
 
     html_path = site.construction[page.url]['v2']
-    with open(html_path, "r") as f:
-        html = f.read()
-
-    # Create the streaming request
-    with client.messages.stream(
-        model="claude-3-7-sonnet-20250219",
-        max_tokens=40000,
-        temperature=0,
-        system=SYSTEM_PROMPT,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"{FUNCTIONALITY_PROMPT}\n\n{html}\n\n{functionality_input}"
-                    }
-                ]
-            }
-        ]
-    ) as stream:
-        # Initialize variables to collect the full response
-        message = None
-        full_response_text = ""
-        
-        # Process each event in the stream
-        for event in stream:
-            if event.type == "message_start":
-                message = event.message
-            elif event.type == "content_block_start":
-                current_block = event.content_block
-            elif event.type == "content_block_delta":
-                if event.delta.text:
-                    full_response_text += event.delta.text
-            elif event.type == "message_delta":
-                if hasattr(event.delta, "usage"):
-                    message.usage = event.delta.usage
-            elif event.type == "message_stop":
-                # Stream is complete
-                pass
+    async with aiofiles.open(html_path, "r") as f:
+        html = await f.read()
+
+    # Send the request (or reuse a cached response)
+    message = await stream_message(client, semaphore, f"{FUNCTIONALITY_PROMPT}\n\n{html}\n\n{functionality_input}", 40000, batch)
+    full_response_text = "".join(block.text for block in message.content if block.type == "text")
                 
     page_name = page.dir
     # Sanitize page name for use in filenames
@@ -335,13 +570,12 @@ def implement_functionality(client, site: Site, page: Page, directory: str):
         output = full_response_text
         
         # Check if the response contains HTML code blocks
-        if "```html" in output and "```" in output.split("```html", 1)[1]:
-            html = output.split("```html")[1].split("```")[0]
-        else:
+        html = extract_html_block(output)
+        if html is None:
             # If no HTML code blocks found, save the raw response for debugging
             debug_path = os.path.join(directory, "debug", f"{safe_page_name}_raw_response.txt")
-            with open(debug_path, "w", encoding="utf-8") as f:
-                f.write(output)
+            async with aiofiles.open(debug_path, "w", encoding="utf-8") as f:
+                await f.write(output)
             print(f"Warning: No HTML code blocks found in response for page {page.url}")
             # Use the raw output as HTML (may not be ideal but prevents failure)
             html = output
@@ -350,61 +584,27 @@ def implement_functionality(client, site: Site, page: Page, directory: str):
         # Return empty HTML as fallback
         html = "<html><body><p>Error extracting HTML from response</p></body></html>"
 
-    with open(html_path, "w", encoding="utf-8") as f:
-        f.write(html)
+    async with aiofiles.open(html_path, "w", encoding="utf-8") as f:
+        await f.write(html)
 
-    return html_path
+    return html_path, html
 
 
-def implement_interactions(client, site: Site, page: Page, directory: str):
+async def implement_interactions(client, site: Site, page: Page, directory: str, semaphore: asyncio.Semaphore, batch=None):
     # Get the HTML path from site.construction
     if page.url in site.construction and 'v1' in site.construction[page.url]:
         html_path = site.construction[page.url]['v1']
     else:
         raise ValueError(f"HTML path not found for page {page.url}")
         
-    with open(html_path, "r") as f:
-        html = f.read()
+    async with aiofiles.open(html_path, "r") as f:
+        html = await f.read()
 
     interactions = page.synthesize_interactions()
     
-    # Create the streaming request
-    with client.messages.stream(
-        model="claude-3-7-sonnet-20250219",
-        max_tokens=20000,
-        temperature=0,
-        system=SYSTEM_PROMPT,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"{INTERACTION_PROMPT}\n\n{html}\n\n{interactions}"
-                    }
-                ]
-            }
-        ]
-    ) as stream:
-        # Initialize variables to collect the full response
-        message = None
-        full_response_text = ""
-        
-        # Process each event in the stream
-        for event in stream:
-            if event.type == "message_start":
-                message = event.message
-            elif event.type == "content_block_start":
-                current_block = event.content_block
-            elif event.type == "content_block_delta":
-                if event.delta.text:
-                    full_response_text += event.delta.text
-            elif event.type == "message_delta":
-                if hasattr(event.delta, "usage"):
-                    message.usage = event.delta.usage
-            elif event.type == "message_stop":
-                # Stream is complete
-                pass
+    # Send the request (or reuse a cached response)
+    message = await stream_message(client, semaphore, f"{INTERACTION_PROMPT}\n\n{html}\n\n{interactions}", 20000, batch)
+    full_response_text = "".join(block.text for block in message.content if block.type == "text")
 
     page_name = page.dir
     # Sanitize page name for use in filenames
@@ -416,20 +616,18 @@ def implement_interactions(client, site: Site, page: Page, directory: str):
     response_text = full_response_text
     
     try:
-        output = json.loads(response_text)
-    except json.JSONDecodeError as e:
+        output = orjson.loads(response_text)
+    except orjson.JSONDecodeError as e:
         print(f"Error parsing JSON response for page {page.url}: {e}")
         print(f"Response text: {response_text[:500]}...")  # Print first 500 chars for debugging
         
         # Save the raw response for debugging
         debug_path = os.path.join(directory, "debug", f"{safe_page_name}_raw_response.txt")
-        os.makedirs(os.path.join(directory, "debug"), exist_ok=True)
-        with open(debug_path, "w", encoding="utf-8") as f:
-            f.write(response_text)
+        async with aiofiles.open(debug_path, "w", encoding="utf-8") as f:
+            await f.write(response_text)
 
-        os.makedirs(os.path.join(directory, "v2"), exist_ok=True)
-        with open(html_path, "w", encoding="utf-8") as f:
-            f.write(html)  # Write the original HTML content
+        async with aiofiles.open(html_path, "w", encoding="utf-8") as f:
+            await f.write(html)  # Write the original HTML content
         
         print(f"JSON parsing failed for {page.url}, using original HTML as fallback")
             
@@ -438,21 +636,21 @@ def implement_interactions(client, site: Site, page: Page, directory: str):
 
     # Write the HTML content to the file
     try:
-        with open(html_path, "w", encoding="utf-8") as f:
-            f.write(output["html"])
+        async with aiofiles.open(html_path, "w", encoding="utf-8") as f:
+            await f.write(output["html"])
     except KeyError:
         print(f"Error: 'html' key not found in output for page {page.url}")
         # Save the parsed output for debugging
         debug_path = os.path.join(directory, "debug", f"{safe_page_name}_parsed_output.json")
-        os.makedirs(os.path.join(directory, "debug"), exist_ok=True)
-        with open(debug_path, "w", encoding="utf-8") as f:
-            json.dump(output, f, indent=2)
+        async with aiofiles.open(debug_path, "wb") as f:
+            await f.write(orjson.dumps(output, option=orjson.OPT_INDENT_2))
         return html_path, []
     
     # Optionally save the JSON for reference
-    json_path = os.path.join(directory, "v2", f"{safe_page_name}_data.json")
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(output, f, indent=2)
+    if SAVE_JSON_SIDECAR:
+        json_path = os.path.join(directory, "v2", f"{safe_page_name}_data.json")
+        async with aiofiles.open(json_path, "wb") as f:
+            await f.write(orjson.dumps(output, option=orjson.OPT_INDENT_2))
     
     if "functionality" in output:
         return html_path, output["functionality"]
@@ -461,93 +659,55 @@ def implement_interactions(client, site: Site, page: Page, directory: str):
 
 # Given a page, initialiaze the HTML for the page
 # Returns the path to the HTML file
-def initialize_html(client, page: Page, directory: str):
+async def initialize_html(client, page: Page, directory: str, semaphore: asyncio.Semaphore, batch=None):
     page_name = page.dir
     # Sanitize page name for use in filenames
     safe_page_name = sanitize_filename(page_name)
     html_path = os.path.join(directory, "v1", f"{safe_page_name}.html")
 
     # Read the HTML content from the file
-    with open(page.html, 'r', encoding='utf-8') as f:
-        page_html = f.read()
-        
-    # Create the streaming request
-    with client.messages.stream(
-        model="claude-3-7-sonnet-20250219",
-        max_tokens=40000,
-        temperature=0,
-        system=SYSTEM_PROMPT,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"Clone this website. Return only the code nested in ```html and ``` tags. Do not provide any textual explanation in your response. {page_html}"
-                    }
-                ]
-            }
-        ]
-    ) as stream:
-        # Initialize variables to collect the full response
-        message = None
-        full_response_text = ""
+    async with aiofiles.open(page.html, 'r', encoding='utf-8') as f:
+        page_html = await f.read()
         
-        # Process each event in the stream
-        for event in stream:
-            if event.type == "message_start":
-                message = event.message
-            elif event.type == "content_block_start":
-                current_block = event.content_block
-            elif event.type == "content_block_delta":
-                if event.delta.text:
-                    full_response_text += event.delta.text
-            elif event.type == "message_delta":
-                if hasattr(event.delta, "usage"):
-                    message.usage = event.delta.usage
-            elif event.type == "message_stop":
-                # Stream is complete
-                pass
+    # Send the request (or reuse a cached response)
+    message = await stream_message(client, semaphore, f"Clone this website. Return only the code nested in ```html and ``` tags. Do not provide any textual explanation in your response. {page_html}", 40000, batch)
+    full_response_text = "".join(block.text for block in message.content if block.type == "text")
                 
     print("Response received")
 
-    # Create a directory to save Anthropic API responses for testing/debugging
-    anthropic_dir = os.path.join(os.getcwd(), "anthropic")
-    os.makedirs(anthropic_dir, exist_ok=True)
+    # Create a serializable message dict
+    message_dict = {
+        "id": message.id,
+        "content": [{"type": "text", "text": full_response_text}],
+        "model": message.model,
+        "role": message.role,
+        "type": message.type
+    }
     
-    # Save the raw API response to a file for reference
-    response_path = os.path.join(anthropic_dir, f"response_{safe_page_name}.json")
-    with open(response_path, "w", encoding="utf-8") as f:
-        # Create a serializable message dict
-        message_dict = {
-            "id": message.id,
-            "content": [{"type": "text", "text": full_response_text}],
-            "model": message.model,
-            "role": message.role,
-            "type": message.type
+    # Add usage information if available
+    if hasattr(message, "usage"):
+        message_dict["usage"] = {
+            "input_tokens": message.usage.input_tokens,
+            "output_tokens": message.usage.output_tokens
         }
-        
-        # Add usage information if available
-        if hasattr(message, "usage"):
-            message_dict["usage"] = {
-                "input_tokens": message.usage.input_tokens,
-                "output_tokens": message.usage.output_tokens
-            }
-            
-        json.dump(message_dict, f, indent=2)
+
+    # Save the raw API response to a file for reference
+    if DEBUG:
+        response_path = os.path.join(ANTHROPIC_DIR, f"response_{safe_page_name}.json")
+        async with aiofiles.open(response_path, "wb") as f:
+            await f.write(orjson.dumps(message_dict, option=orjson.OPT_INDENT_2))
 
     try:
         # Use the collected full response text
         output = full_response_text
         
         # Check if the response contains HTML code blocks
-        if "```html" in output and "```" in output.split("```html", 1)[1]:
-            html = output.split("```html")[1].split("```")[0]
-        else:
+        html = extract_html_block(output)
+        if html is None:
             # If no HTML code blocks found, save the raw response for debugging
             debug_path = os.path.join(directory, "debug", f"{safe_page_name}_raw_response.txt")
-            with open(debug_path, "w", encoding="utf-8") as f:
-                f.write(output)
+            async with aiofiles.open(debug_path, "w", encoding="utf-8") as f:
+                await f.write(output)
             print(f"Warning: No HTML code blocks found in response for page {page.url}")
             # Use the raw output as HTML (may not be ideal but prevents failure)
             html = output
@@ -555,11 +715,11 @@ def initialize_html(client, page: Page, directory: str):
         print(f"Error extracting HTML from response for page {page.url}: {e}")
         # Save the raw message for debugging
         debug_path = os.path.join(directory, "debug", f"{safe_page_name}_error.json")
-        with open(debug_path, "w", encoding="utf-8") as f:
-            json.dump(message_dict, f, indent=2)
+        async with aiofiles.open(debug_path, "wb") as f:
+            await f.write(orjson.dumps(message_dict, option=orjson.OPT_INDENT_2))
         # Return empty HTML as fallback
         html = "<html><body><p>Error extracting HTML from response</p></body></html>"
 
-    with open(html_path, "w", encoding="utf-8") as f:
-        f.write(html)
+    async with aiofiles.open(html_path, "w", encoding="utf-8") as f:
+        await f.write(html)
     return html_path
\ No newline at end of file
@@ -2,16 +2,34 @@ import os
 import re
 import json
 import shutil
-import dotenv
-import anthropic
+import asyncio
+import aiofiles
+import functools
+import orjson
+from anthropic.types import TextBlock
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse, urljoin
 from data_models import Page, Site, Interaction
 import base64
 from utils import get_sanitized_name_from_url
+from workflows.clone_workflow import (
+    ANTHROPIC_DIR, API_CONCURRENCY, BATCH_POLL_SECONDS, DEBUG, LLM_CACHE_ENABLED, LLM_CACHE_DIR, MODEL,
+    get_client, message_params, gather_stage, stage_batch, api_breaker, rate_limiter, estimate_input_tokens,
+    read_cached_message, write_cached_message
+)
 
 map_url_to_file = {}
 
+# Links that don't map directly to a local file are only sent to Claude when this is set
+LLM_LINK_FIX_ENABLED = os.environ.get("YUTORI_LLM_LINK_FIX") == "1"
+
+# Pages can be several MB, so write them through a larger buffer than the 8 KiB default
+WRITE_BUFFER_SIZE = 1 << 18
+
+# JavaScript code blocks in Claude's response, and characters that can't appear in filenames
+JS_BLOCK_RE = re.compile(r'```(?:javascript|js)(.*?)```', re.DOTALL)
+SANITIZE_RE = re.compile(r'[\\/*?:"<>|]')
+
 # System prompt for the LLM
 SYSTEM_PROMPT = """You are an intelligent web developer that specializes in producing websites from top tier design companies. 
 Do your absolute best to create the page or else you will be fired.
@@ -40,66 +58,39 @@ Return ONLY the JavaScript code to be injected into the page. Do not include any
 Your code should be wrapped in a self-executing function to avoid global scope pollution.
 """
 
-# Prompt for fixing individual links
-LINK_FIX_PROMPT = """I need to update a link in an HTML page to point to the correct local file.
+# The system prompt is the same for every request, so mark it for prompt caching
+CACHED_SYSTEM_PROMPT = [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
 
-Original link: {original_link}
-Original page URL: {page_url}
-Link text: {link_text}
-
-Available local HTML files:
+# Site-wide context for fixing links. It's identical for every link, so it's sent as its own cached block
+LINK_FIX_CONTEXT_PROMPT = """Available local HTML files:
 {available_files}
 
 URL mapping information:
 {url_mapping}
-
-If this link points to a page that exists in our local collection, return the correct local filename.
-If it's an external link or points to a page we don't have locally, return the original link.
-For relative links (starting with / or without http), try to match them to our local files.
-
-Return ONLY the corrected link path with no explanation or additional text.
 """
 
-# New prompt for batch processing links
-BATCH_LINK_FIX_PROMPT = """I need to update multiple links in an HTML page to point to the correct local files.
+# Prompt for fixing individual links
+LINK_FIX_PROMPT = """I need to update a link in an HTML page to point to the correct local file, using the local files and URL mapping above.
 
+Original link: {original_link}
 Original page URL: {page_url}
+Link text: {link_text}
 
-Available local HTML files:
-{available_files}
-
-URL mapping information:
-{url_mapping}
-
-Here are the links that need to be updated:
-{links_to_fix}
-
-For each link, determine if it points to a page that exists in our local collection:
-- If it does, provide the correct local filename
-- If it's an external link or points to a page we don't have locally, return the original link
-- For relative links (starting with / or without http), try to match them to our local files
-
-Return your answers in a JSON format where each key is the link ID and the value is the corrected link path.
-The JSON must be valid and properly formatted with no line breaks within the values.
-
-Example of the expected JSON format:
-{
-  "link_1": "corrected_path_1.html",
-  "link_2": "corrected_path_2.html",
-  "link_3": "original_link_3"
-}
+If this link points to a page that exists in our local collection, return the correct local filename.
+If it's an external link or points to a page we don't have locally, return the original link.
+For relative links (starting with / or without http), try to match them to our local files.
 
-IMPORTANT: Your response must contain ONLY the JSON object with no additional text, explanation, or formatting.
-Do not include any text before or after the JSON object. The JSON must be valid and parseable.
+Return ONLY the corrected link path with no explanation or additional text.
 """
 
-def enhanced_injection_workflow(site: Site):
+async def enhanced_injection_workflow(site: Site, use_batch_api: bool = False, resume: bool = False):
     """
     Creates a local clone of the site with enhanced functionality:
     1. Copies original HTML to a 'source_html' folder
     2. Identifies and implements functionality for interactive elements
     3. Rewrites links to connect pages properly
     4. Saves final pages to 'cloned_injection' folder
+    With resume, pages that an interrupted run already finished are skipped.
     """
     print("Starting enhanced injection workflow...")
     
@@ -110,18 +101,35 @@ def enhanced_injection_workflow(site: Site):
     final_dir = os.path.join(base_dir, "cloned_injection", "final")
     
     # Create directories
-    for directory in [source_dir, functionality_dir, final_dir]:
+    for directory in [source_dir, os.path.join(source_dir, "debug"), functionality_dir, final_dir]:
         os.makedirs(directory, exist_ok=True)
-    
-    # Initialize Anthropic client
+    if DEBUG:
+        os.makedirs(ANTHROPIC_DIR, exist_ok=True)
+    
+    # Every finished page step is appended to the progress file. A resumed run skips those steps,
+    # a fresh run starts the file over.
+    progress_path = os.path.join(base_dir, "cloned_injection", ".progress.jsonl")
+    if resume:
+        completed = load_progress(progress_path)
+        print(f"Resuming with {len(completed)} completed page steps")
+    else:
+        completed = set()
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+    if LLM_CACHE_ENABLED:
+        os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+    
+    # Use the process-wide Anthropic client, so every step (and the clone workflow) shares one
+    # connection pool and .env is only read once. The SDK retries rate limits and server errors with backoff.
     try:
-        client = anthropic.Anthropic(
-            api_key=dotenv.get_key(".env", "ANTHROPIC_API_KEY")
-        )
+        client = get_client()
     except Exception as e:
         print(f"Error initializing Anthropic client: {e}")
         return site
     
+    # Pages are independent, so each step runs them concurrently under this limit
+    semaphore = asyncio.Semaphore(API_CONCURRENCY)
+    
     # Get total number of pages for progress tracking
     pages = list(site.get_pages())
     total_pages = len(pages)
@@ -134,7 +142,7 @@ def enhanced_injection_workflow(site: Site):
     
     # Step 1: Copy all HTML files to source_html directory
     print("\nStep 1: Copying HTML files to source directory...")
-    file_mapping = copy_html_to_source_dir(site, source_dir)
+    file_mapping = await copy_html_to_source_dir(client, site, source_dir, progress_path, completed, semaphore)
     
     # Check if we have any files to process
     if not file_mapping:
@@ -145,46 +153,140 @@ def enhanced_injection_workflow(site: Site):
     print("\nStep 2: Implementing functionality for interactive elements...")
     functionality_success = 0
     
+    stage_pages = []
     for i, page in enumerate(pages, 1):
-        print(f"\nProcessing page {i}/{total_pages}: {page.url}")
-        try:
-            source_file = file_mapping.get(page.url)
-            if not source_file:
-                print(f"  Warning: No source file found for {page.url}")
-                continue
-                
-            implement_page_functionality(client, page, source_file, functionality_dir)
+        print(f"\nQueueing page {i}/{total_pages}: {page.url}")
+        if not file_mapping.get(page.url):
+            print(f"  Warning: No source file found for {page.url}")
+            continue
+        output_file = os.path.join(functionality_dir, os.path.basename(file_mapping[page.url]))
+        if ("functionality", page.url) in completed and os.path.exists(output_file):
+            print(f"  Functionality already implemented for {page.url}, skipping")
             functionality_success += 1
-        except Exception as e:
-            print(f"  Error implementing functionality for {page.url}: {e}")
+            continue
+        stage_pages.append(page)
+    
+    async def implement_and_record(page, batch):
+        soup = await implement_page_functionality(client, page, file_mapping[page.url], functionality_dir, semaphore, batch)
+        # A None result means the Claude call failed and the source was copied, so it isn't recorded as done
+        if soup is not None:
+            # The fsync would otherwise stall the other pages' requests
+            await asyncio.to_thread(record_progress, progress_path, "functionality", page.url)
+        return soup
+    
+    # With use_batch_api, every page's request goes out in one Message Batch instead
+    batch = stage_batch(client, stage_pages, use_batch_api)
+    results = await gather_stage(
+        (implement_and_record(page, batch) for page in stage_pages),
+        batch
+    )
+    # Keep each page's parsed tree so step 3 doesn't have to read and parse it again
+    page_soups = {}
+    for page, result in zip(stage_pages, results):
+        if isinstance(result, Exception):
+            print(f"  Error implementing functionality for {page.url}: {result}")
+        else:
+            functionality_success += 1
+            if result is not None:
+                page_soups[page.url] = result
     
     print(f"\nFunctionality implementation complete. Successfully processed {functionality_success}/{total_pages} pages.")
     
     # Step 3: Fix links between pages
     print("\nStep 3: Fixing links between pages...")
-    available_files = os.listdir(functionality_dir)
+    # A set so each link's "already local" check is a single lookup
+    available_files = frozenset(os.listdir(functionality_dir))
     link_fixing_success = 0
     
+    # The URL mapping and the prompt context built from it are the same for every page,
+    # so build them once for the whole site
+    url_to_file_map = build_url_to_file_map(site)
+    site_domains = {urlparse(p.url).netloc for p in pages}
+    available_files_str = "\n".join(sorted(available_files))
+    url_mapping_info = "\n".join([f"Original URL: {url} -> Local file: {filename}" 
+                                 for url, filename in url_to_file_map.items()])
+    link_fix_context = LINK_FIX_CONTEXT_PROMPT.format(
+        available_files=available_files_str,
+        url_mapping=url_mapping_info
+    )
+    
+    stage_pages = []
     for i, page in enumerate(pages, 1):
-        print(f"\nFixing links for page {i}/{total_pages}: {page.url}")
+        print(f"\nQueueing link fixing for page {i}/{total_pages}: {page.url}")
+        page_filename = sanitize_filename(page.dir) + ".html"
+        functionality_file = os.path.join(functionality_dir, page_filename)
+        
+        if not os.path.exists(functionality_file):
+            print(f"  Warning: No functionality file found for {page.url}")
+            continue
+        if ("links", page.url) in completed and os.path.exists(os.path.join(final_dir, page_filename)):
+            print(f"  Links already fixed for {page.url}, skipping")
+            link_fixing_success += 1
+            continue
+        stage_pages.append((page, functionality_file))
+    
+    results = await asyncio.gather(
+        *(fix_page_links(page, functionality_file, available_files, url_to_file_map, site_domains, page_soups.get(page.url)) for page, functionality_file in stage_pages),
+        return_exceptions=True
+    )
+    
+    # Collect the links that couldn't be mapped directly from every page so they go out as one batch.
+    # Repeated links (same href, text and page, e.g. nav and footer copies) share a single request.
+    link_prompts = {}
+    prompt_ids = {}
+    link_ids = {}
+    for page_idx, result in enumerate(results):
+        if isinstance(result, Exception):
+            continue
+        for link_idx, (link, link_prompt) in enumerate(result[1]):
+            custom_id = prompt_ids.setdefault(link_prompt, f"{page_idx}-{link_idx}")
+            link_prompts[custom_id] = link_prompt
+            link_ids[(page_idx, link_idx)] = custom_id
+    
+    corrected_links = {}
+    if link_prompts:
+        print(f"{len(link_ids)} links need Claude to resolve them, sent as {len(link_prompts)} distinct requests")
         try:
-            page_filename = sanitize_filename(page.dir) + ".html"
-            functionality_file = os.path.join(functionality_dir, page_filename)
+            corrected_links = await fix_links_with_batch(client, link_prompts, link_fix_context)
+        except Exception as e:
+            print(f"  Error fixing links in batch: {e}")
+    
+    for page_idx, ((page, functionality_file), result) in enumerate(zip(stage_pages, results)):
+        page_filename = os.path.basename(functionality_file)
+        final_file = os.path.join(final_dir, page_filename)
+        try:
+            if isinstance(result, Exception):
+                raise result
             
-            if not os.path.exists(functionality_file):
-                print(f"  Warning: No functionality file found for {page.url}")
-                continue
-                
-            fix_page_links(client, page, functionality_file, final_dir, available_files, site)
+            soup, unresolved_links, links_changed = result
+            # A page only counts as done once every link it queued got an answer, so a resumed
+            # run retries pages whose links were lost to a failed batch
+            all_answered = True
+            for link_idx, (link, link_prompt) in enumerate(unresolved_links):
+                original_href = link.get("href", "")
+                corrected_link = corrected_links.get(link_ids[(page_idx, link_idx)])
+                if corrected_link is None:
+                    all_answered = False
+                if corrected_link and corrected_link != original_href:
+                    link["href"] = corrected_link
+                    links_changed = True
+                    print(f"Updated link: {original_href} -> {corrected_link}")
+            
+            if links_changed:
+                # Write the updated HTML to the output file as UTF-8 bytes
+                async with aiofiles.open(final_file, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                    await f.write(soup.encode(formatter="minimal"))
+            else:
+                # Nothing changed, so the page from step 2 can be copied as is
+                await asyncio.to_thread(shutil.copyfile, functionality_file, final_file)
+            if all_answered:
+                await asyncio.to_thread(record_progress, progress_path, "links", page.url)
             link_fixing_success += 1
         except Exception as e:
             print(f"  Error fixing links for {page.url}: {e}")
             # Try to copy the file anyway to ensure we have something in the final directory
             try:
-                page_filename = sanitize_filename(page.dir) + ".html"
-                functionality_file = os.path.join(functionality_dir, page_filename)
-                final_file = os.path.join(final_dir, page_filename)
-                shutil.copy(functionality_file, final_file)
+                await asyncio.to_thread(shutil.copyfile, functionality_file, final_file)
                 print(f"  Copied file without link fixing: {page_filename}")
             except Exception as copy_error:
                 print(f"  Error copying file: {copy_error}")
@@ -200,7 +302,7 @@ def enhanced_injection_workflow(site: Site):
     
     return site
 
-def initialize_html(client, page: Page, directory: str):
+async def initialize_html(client, page: Page, directory: str, semaphore: asyncio.Semaphore):
     """
     Uses Anthropic to generate a clean HTML version of the page.
     Only used for specific pages like feed pages.
@@ -210,78 +312,84 @@ def initialize_html(client, page: Page, directory: str):
     safe_page_name = sanitize_filename(page_name)
     html_path = os.path.join(directory, "v1", f"{safe_page_name}.html")
 
-    # Create debug directory if it doesn't exist
+    # Created by the workflow along with the other output directories
     debug_dir = os.path.join(directory, "debug")
-    os.makedirs(debug_dir, exist_ok=True)
 
     # Read the HTML content from the file
-    with open(page.html, 'r', encoding='utf-8') as f:
-        page_html = f.read()
+    async with aiofiles.open(page.html, 'r', encoding='utf-8') as f:
+        page_html = await f.read()
         
-    # Create the streaming request
-    with client.messages.stream(
-        model="claude-3-7-sonnet-20250219",
-        max_tokens=20000,
-        temperature=1,
-        system=SYSTEM_PROMPT,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"Clone this website. Return only the code nested in ```html and ``` tags. Do not provide any textual explanation in your response. {page_html}"
-                    }
-                ]
-            }
-        ]
-    ) as stream:
-        # Initialize variables to collect the full response
-        message = None
-        full_response_text = ""
+    # The clone runs at temperature 0 like the other stages, so a cached response can stand in for the call
+    params = message_params(f"Clone this website. Return only the code nested in ```html and ``` tags. Do not provide any textual explanation in your response. {page_html}", 20000)
+    message = await read_cached_message(params)
+    if message is not None:
+        full_response_text = message.content[0].text
+    else:
+        # Create the streaming request
+        async with semaphore, api_breaker.guard(), rate_limiter.acquire(estimate_input_tokens(params)), client.messages.stream(**params) as stream:
+            # Initialize variables to collect the full response
+            message = None
+            response_parts = []
+        
+            # Only the ```html block is used, so the stream is closed as soon as that block ends.
+            # The tail keeps just enough text to spot a fence split across deltas.
+            fence_opened = False
+            tail = ""
         
-        # Process each event in the stream
-        for event in stream:
-            if event.type == "message_start":
-                message = event.message
-            elif event.type == "content_block_start":
-                current_block = event.content_block
-            elif event.type == "content_block_delta":
-                if event.delta.text:
-                    full_response_text += event.delta.text
-            elif event.type == "message_delta":
-                if hasattr(event.delta, "usage"):
-                    message.usage = event.delta.usage
-            elif event.type == "message_stop":
-                # Stream is complete
-                pass
-                
+            # Process each event in the stream
+            async for event in stream:
+                if event.type == "message_start":
+                    message = event.message
+                elif event.type == "content_block_start":
+                    current_block = event.content_block
+                elif event.type == "content_block_delta":
+                    if event.delta.text:
+                        response_parts.append(event.delta.text)
+                        tail += event.delta.text
+                        if not fence_opened:
+                            start = tail.find("```html")
+                            if start == -1:
+                                tail = tail[-6:]
+                                continue
+                            fence_opened = True
+                            tail = tail[start + len("```html"):]
+                        if "```" in tail:
+                            break
+                        tail = tail[-2:]
+                elif event.type == "message_delta":
+                    if hasattr(event.delta, "usage"):
+                        message.usage = event.delta.usage
+                elif event.type == "message_stop":
+                    # Stream is complete
+                    pass
+
+        full_response_text = "".join(response_parts)
+        # Only the text read before the stream was closed is kept, which is also what gets cached
+        message = message.model_copy(update={"content": [TextBlock(type="text", text=full_response_text)]})
+        await write_cached_message(params, message)
     print("Response received")
 
-    # Create a directory to save Anthropic API responses for testing/debugging
-    anthropic_dir = os.path.join(os.getcwd(), "anthropic")
-    os.makedirs(anthropic_dir, exist_ok=True)
+    # Create a serializable message dict
+    message_dict = {
+        "id": message.id,
+        "content": [{"type": "text", "text": full_response_text}],
+        "model": message.model,
+        "role": message.role,
+        "type": message.type
+    }
     
-    # Save the raw API response to a file for reference
-    response_path = os.path.join(anthropic_dir, f"response_{safe_page_name}.json")
-    with open(response_path, "w", encoding="utf-8") as f:
-        # Create a serializable message dict
-        message_dict = {
-            "id": message.id,
-            "content": [{"type": "text", "text": full_response_text}],
-            "model": message.model,
-            "role": message.role,
-            "type": message.type
+    # Add usage information if available
+    if hasattr(message, "usage"):
+        message_dict["usage"] = {
+            "input_tokens": message.usage.input_tokens,
+            "output_tokens": message.usage.output_tokens
         }
-        
-        # Add usage information if available
-        if hasattr(message, "usage"):
-            message_dict["usage"] = {
-                "input_tokens": message.usage.input_tokens,
-                "output_tokens": message.usage.output_tokens
-            }
-            
-        json.dump(message_dict, f, indent=2)
+    
+    # Save the raw API response to a file for reference
+    if DEBUG:
+        response_path = os.path.join(ANTHROPIC_DIR, f"response_{safe_page_name}.json")
+        async with aiofiles.open(response_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            await f.write(orjson.dumps(message_dict, option=orjson.OPT_INDENT_2))
 
     try:
         # Use the collected full response text
@@ -293,8 +401,8 @@ def initialize_html(client, page: Page, directory: str):
         else:
             # If no HTML code blocks found, save the raw response for debugging
             debug_path = os.path.join(debug_dir, f"{safe_page_name}_raw_response.txt")
-            with open(debug_path, "w", encoding="utf-8") as f:
-                f.write(output)
+            async with aiofiles.open(debug_path, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as f:
+                await f.write(output)
             print(f"Warning: No HTML code blocks found in response for page {page.url}")
             # Use the raw output as HTML (may not be ideal but prevents failure)
             html = output
@@ -302,19 +410,19 @@ def initialize_html(client, page: Page, directory: str):
         print(f"Error extracting HTML from response for page {page.url}: {e}")
         # Save the raw message for debugging
         debug_path = os.path.join(debug_dir, f"{safe_page_name}_error.json")
-        with open(debug_path, "w", encoding="utf-8") as f:
-            json.dump(message_dict, f, indent=2)
+        async with aiofiles.open(debug_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            await f.write(orjson.dumps(message_dict, option=orjson.OPT_INDENT_2))
         # Return empty HTML as fallback
         html = "<html><body><p>Error extracting HTML from response</p></body></html>"
 
-    with open(html_path, "w", encoding="utf-8") as f:
-        f.write(html)
+    async with aiofiles.open(html_path, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as f:
+        await f.write(html)
     return html_path
 
-def copy_html_to_source_dir(site: Site, source_dir: str) -> dict:
+async def copy_html_to_source_dir(client, site: Site, source_dir: str, progress_path: str, completed: set, semaphore: asyncio.Semaphore) -> dict:
     """
     Copies all HTML files to the source directory with sanitized filenames.
-    For feed pages, uses Anthropic to generate a clean HTML version.
+    For feed pages, uses Anthropic to generate a clean HTML version, unless a previous run already did.
     Returns a mapping of URLs to their corresponding source files.
     """
     file_mapping = {}
@@ -323,15 +431,6 @@ def copy_html_to_source_dir(site: Site, source_dir: str) -> dict:
     v1_dir = os.path.join(source_dir, "v1")
     os.makedirs(v1_dir, exist_ok=True)
     
-    # Initialize Anthropic client for feed pages
-    try:
-        client = anthropic.Anthropic(
-            api_key=dotenv.get_key(".env", "ANTHROPIC_API_KEY")
-        )
-    except Exception as e:
-        print(f"Error initializing Anthropic client for feed pages: {e}")
-        client = None
-    
     for page in site.get_pages():
         if not page.html or not os.path.exists(page.html):
             print(f"Warning: No HTML file found for {page.url}")
@@ -343,38 +442,69 @@ def copy_html_to_source_dir(site: Site, source_dir: str) -> dict:
         # Check if this is a feed page
         is_feed_page = "ubereats.com/feed" in page.url
         
-        if is_feed_page and client:
+        initialized_path = os.path.join(v1_dir, safe_filename)
+        if is_feed_page and ("source", page.url) in completed and os.path.exists(initialized_path):
+            print(f"Feed page already initialized: {page.url}")
+            file_mapping[page.url] = initialized_path
+        elif is_feed_page:
             print(f"Initializing feed page: {page.url}")
             try:
                 # Use Anthropic to generate a clean HTML version
-                html_path = initialize_html(client, page, source_dir)
+                html_path = await initialize_html(client, page, source_dir, semaphore)
                 file_mapping[page.url] = html_path
+                await asyncio.to_thread(record_progress, progress_path, "source", page.url)
                 print(f"Initialized feed page {page.url} to {html_path}")
             except Exception as e:
                 print(f"Error initializing feed page {page.url}: {e}")
                 # Fall back to regular copying
-                copy_regular_html(page, dest_path, file_mapping)
+                await asyncio.to_thread(copy_regular_html, page, dest_path, file_mapping)
         else:
             # Regular copying for non-feed pages
-            copy_regular_html(page, dest_path, file_mapping)
+            await asyncio.to_thread(copy_regular_html, page, dest_path, file_mapping)
     
     return file_mapping
 
+def load_progress(progress_path: str) -> set:
+    """Reads the (step, url) pairs recorded as done by a previous run."""
+    completed = set()
+    if not os.path.exists(progress_path):
+        return completed
+    with open(progress_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write can leave a partial last line
+                continue
+            if entry.get("ok"):
+                completed.add((entry["step"], entry["url"]))
+    return completed
+
+def record_progress(progress_path: str, step: str, url: str):
+    """Appends a finished page step to the progress file and syncs it so it survives a crash."""
+    with open(progress_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"step": step, "url": url, "ok": True}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
 def copy_regular_html(page: Page, dest_path: str, file_mapping: dict):
     """Helper function to copy regular HTML files."""
     try:
-        with open(page.html, "r", encoding="utf-8") as f_src:
-            html_content = f_src.read()
-            
-        with open(dest_path, "w", encoding="utf-8") as f_dest:
-            f_dest.write(html_content)
+        # Nothing is transformed, so let the kernel copy the bytes without decoding them
+        shutil.copyfile(page.html, dest_path)
             
         file_mapping[page.url] = dest_path
         print(f"Copied {page.url} to {dest_path}")
     except Exception as e:
         print(f"Error copying HTML for {page.url}: {e}")
 
-def implement_page_functionality(client, page: Page, source_file: str, output_dir: str):
+@functools.lru_cache(maxsize=256)
+def encode_screenshot(path: str, mtime: float) -> str:
+    """Base64-encodes a screenshot. The mtime is part of the cache key so a replaced file is re-read."""
+    with open(path, "rb") as img_file:
+        return base64.b64encode(img_file.read()).decode("utf-8")
+
+async def implement_page_functionality(client, page: Page, source_file: str, output_dir: str, semaphore: asyncio.Semaphore, batch=None):
     """
     Identifies interactive elements in the page and implements functionality for them.
     Uses Anthropic to generate JavaScript code for the functionality.
@@ -383,20 +513,21 @@ def implement_page_functionality(client, page: Page, source_file: str, output_di
     output_file = os.path.join(output_dir, page_filename)
     
     # Read the HTML content
-    with open(source_file, "r", encoding="utf-8") as f:
-        html_content = f.read()
+    async with aiofiles.open(source_file, "r", encoding="utf-8") as f:
+        html_content = await f.read()
     
-    # Parse the HTML with BeautifulSoup
-    soup = BeautifulSoup(html_content, "html.parser")
+    # Parse the HTML with BeautifulSoup in a worker thread, so the event loop keeps
+    # servicing the other pages' API calls while this page is parsed and scanned
+    soup = await asyncio.to_thread(BeautifulSoup, html_content, "lxml")
     
     # Find all potentially interactive elements
-    interactive_elements = find_interactive_elements(soup)
+    interactive_elements = await asyncio.to_thread(find_interactive_elements, soup)
     
     if not interactive_elements:
         print(f"No interactive elements found in {page.url}")
         # Just copy the file to the output directory
-        shutil.copy(source_file, output_file)
-        return
+        await asyncio.to_thread(shutil.copyfile, source_file, output_file)
+        return soup
     
     # Group elements by type for better context
     element_groups = {
@@ -455,19 +586,21 @@ def implement_page_functionality(client, page: Page, source_file: str, output_di
     
     # Prepare the text prompt
     text_prompt = f"""
-{FUNCTIONALITY_PROMPT}
-
 Page URL: {page.url}
 Page Title: {page_title}
 
 Interactive elements found:
 {elements_info_str}
 
-{soup.prettify()[400:900]}
+{html_content[400:900]}
 """
 
-    # Prepare message content with text and images from interactions
-    message_content = [{"type": "text", "text": text_prompt}]
+    # Prepare message content with text and images from interactions. The instructions are the
+    # same for every page, so they go first in their own cached block.
+    message_content = [
+        {"type": "text", "text": FUNCTIONALITY_PROMPT, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": text_prompt}
+    ]
     
     # Add images from interactions if available
     if page.interactions:
@@ -475,9 +608,12 @@ Interactive elements found:
         for idx, interaction in enumerate(page.interactions):
             if interaction.interaction_screenshot and os.path.exists(interaction.interaction_screenshot):
                 try:
-                    # Read and encode the image
-                    with open(interaction.interaction_screenshot, "rb") as img_file:
-                        img_data = base64.b64encode(img_file.read()).decode("utf-8")
+                    # Read and encode the image, reusing the encoding while the file is unchanged
+                    img_data = await asyncio.to_thread(
+                        encode_screenshot,
+                        interaction.interaction_screenshot,
+                        os.path.getmtime(interaction.interaction_screenshot)
+                    )
                     
                     # Add image description
                     message_content.append({
@@ -505,26 +641,34 @@ Interactive elements found:
     
     # Call Anthropic to generate JavaScript code
     try:
-        response = client.messages.create(
-            model="claude-3-7-sonnet-20250219",
-            max_tokens=20000,
-            temperature=0,
-            system=SYSTEM_PROMPT,
-            messages=[
+        params = {
+            "model": MODEL,
+            "max_tokens": 20000,
+            "temperature": 0,
+            "system": CACHED_SYSTEM_PROMPT,
+            "messages": [
                 {
                     "role": "user",
                     "content": message_content
                 }
             ]
-        )
+        }
+        response = await read_cached_message(params)
+        if response is None:
+            if batch is not None:
+                response = await batch.submit(params)
+            else:
+                async with semaphore, api_breaker.guard(), rate_limiter.acquire(estimate_input_tokens(params)):
+                    response = await client.messages.create(**params)
+            await write_cached_message(params, response)
         
         js_code = response.content[0].text
-        print(js_code)
+        if DEBUG:
+            print(js_code)
         # Extract JavaScript code from code blocks if present
         if "```javascript" in js_code or "```js" in js_code:
             # Extract code from JavaScript code blocks
-            import re
-            js_blocks = re.findall(r'```(?:javascript|js)(.*?)```', js_code, re.DOTALL)
+            js_blocks = JS_BLOCK_RE.findall(js_code)
             if js_blocks:
                 js_code = "\n\n".join(js_blocks)
         
@@ -542,79 +686,83 @@ Interactive elements found:
 }})();
 """
         
-        # Inject the JavaScript code into the HTML
+        # Inject the JavaScript code into the HTML. The soup is kept up to date for link fixing,
+        # but the file is written by splicing the script into the original text instead of
+        # serializing the whole tree again.
         inject_javascript(soup, js_code)
+        if 'id="injected-functionality"' in html_content:
+            output_html = soup.encode(formatter="minimal")
+        else:
+            output_html = splice_script(html_content, js_code).encode("utf-8")
         
         # Write the updated HTML to the output file
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write(str(soup))
+        async with aiofiles.open(output_file, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            await f.write(output_html)
             
         print(f"Implemented functionality for {page.url}")
+        return soup
     except Exception as e:
         print(f"Error calling Anthropic for {page.url}: {e}")
         # In case of error, just copy the original file
-        shutil.copy(source_file, output_file)
+        await asyncio.to_thread(shutil.copyfile, source_file, output_file)
+        return None
+
+# Any anchor tag, used to skip pages that have no links to fix
+LINK_TAG_RE = re.compile(r"<a[\s>]", re.IGNORECASE)
+
+# Closing tags the injected script is spliced in front of
+BODY_CLOSE_RE = re.compile(r"</body\s*>", re.IGNORECASE)
+HTML_CLOSE_RE = re.compile(r"</html\s*>", re.IGNORECASE)
+
+# Class names, data attributes, event handlers and ARIA roles that suggest an element is interactive
+INTERACTIVE_LINK_CLASSES = ["btn", "button", "nav", "menu", "tab", "filter", "toggle", "dropdown", 
+                            "accordion", "collapse", "expand", "modal", "popup", "dialog"]
+INTERACTIVE_CLASSES = ["clickable", "dropdown", "accordion", "toggle", "modal", "popup", "slider", 
+                       "carousel", "tab", "filter", "sort", "pagination", "search", "checkbox", 
+                       "radio", "switch", "menu", "submenu", "nav-item", "collapsible"]
+INTERACTIVE_DATA_ATTRS = ["data-toggle", "data-target", "data-dismiss", "data-action", 
+                          "data-slide", "data-filter", "data-sort", "data-role", "data-bind"]
+EVENT_ATTRS = ["onclick", "onchange", "onsubmit", "onmouseover", "onmouseout", 
+               "onfocus", "onblur", "onkeyup", "onkeydown", "onload"]
+INTERACTIVE_ROLES = ["button", "link", "checkbox", "radio", "tab", "tabpanel", 
+                     "menu", "menuitem", "combobox", "slider", "switch"]
+
+INTERACTIVE_TAGS = frozenset({"button", "form", "input", "select", "textarea"})
+INTERACTIVE_ATTRS = frozenset(INTERACTIVE_DATA_ATTRS + EVENT_ATTRS)
+INTERACTIVE_ROLE_SET = frozenset(INTERACTIVE_ROLES)
+INTERACTIVE_LINK_CLASS_RE = re.compile("|".join(map(re.escape, INTERACTIVE_LINK_CLASSES)), re.IGNORECASE)
+INTERACTIVE_CLASS_RE = re.compile("|".join(map(re.escape, INTERACTIVE_CLASSES)), re.IGNORECASE)
+
+def is_interactive_element(el) -> bool:
+    """
+    Checks every interactive signal at once so the page only has to be walked a single time.
+    """
+    if el.name in INTERACTIVE_TAGS:
+        return True
+    attrs = el.attrs
+    if not attrs:
+        return False
+    if attrs.get("type") == "button" or attrs.get("role") in INTERACTIVE_ROLE_SET:
+        return True
+    if not INTERACTIVE_ATTRS.isdisjoint(attrs):
+        return True
+    classes = attrs.get("class")
+    if classes:
+        # bs4 already splits class into a list, so match each token without joining them back up.
+        # None of the patterns contain a space, so this finds the same matches as the joined string.
+        if isinstance(classes, str):
+            classes = (classes,)
+        if any(INTERACTIVE_CLASS_RE.search(cls) for cls in classes):
+            return True
+        if el.name == "a" and any(INTERACTIVE_LINK_CLASS_RE.search(cls) for cls in classes):
+            return True
+    return False
 
 def find_interactive_elements(soup: BeautifulSoup) -> list:
     """
-    Finds all potentially interactive elements in the HTML.
+    Finds all potentially interactive elements in the HTML, in document order.
     """
-    interactive_elements = []
-    
-    # Find all buttons
-    buttons = soup.find_all("button") + soup.find_all(attrs={"type": "button"})
-    interactive_elements.extend(buttons)
-    
-    # Find all links that might be interactive (e.g., have onclick attributes or specific classes)
-    interactive_link_classes = ["btn", "button", "nav", "menu", "tab", "filter", "toggle", "dropdown", 
-                               "accordion", "collapse", "expand", "modal", "popup", "dialog"]
-    links = soup.find_all("a", attrs={"onclick": True}) + soup.find_all("a", class_=lambda c: c and any(cls in str(c).lower() for cls in interactive_link_classes))
-    interactive_elements.extend(links)
-    
-    # Find all form elements
-    forms = soup.find_all("form")
-    interactive_elements.extend(forms)
-    
-    # Find all inputs, selects, and textareas
-    inputs = soup.find_all(["input", "select", "textarea"])
-    interactive_elements.extend(inputs)
-    
-    # Find elements with common interactive class names or attributes
-    interactive_classes = ["clickable", "dropdown", "accordion", "toggle", "modal", "popup", "slider", 
-                          "carousel", "tab", "filter", "sort", "pagination", "search", "checkbox", 
-                          "radio", "switch", "menu", "submenu", "nav-item", "collapsible"]
-    
-    for cls in interactive_classes:
-        elements = soup.find_all(class_=lambda c: c and cls.lower() in str(c).lower())
-        interactive_elements.extend(elements)
-    
-    # Find elements with data attributes that suggest interactivity
-    interactive_data_attrs = ["data-toggle", "data-target", "data-dismiss", "data-action", 
-                             "data-slide", "data-filter", "data-sort", "data-role", "data-bind"]
-    
-    for attr in interactive_data_attrs:
-        elements = soup.find_all(attrs={attr: True})
-        interactive_elements.extend(elements)
-    
-    # Find elements with onclick, onchange, or other event attributes
-    event_attrs = ["onclick", "onchange", "onsubmit", "onmouseover", "onmouseout", 
-                  "onfocus", "onblur", "onkeyup", "onkeydown", "onload"]
-    
-    for attr in event_attrs:
-        elements = soup.find_all(attrs={attr: True})
-        interactive_elements.extend(elements)
-    
-    # Find elements with ARIA roles that suggest interactivity
-    interactive_roles = ["button", "link", "checkbox", "radio", "tab", "tabpanel", 
-                        "menu", "menuitem", "combobox", "slider", "switch"]
-    
-    for role in interactive_roles:
-        elements = soup.find_all(attrs={"role": role})
-        interactive_elements.extend(elements)
-    
-    # Remove duplicates while preserving order
-    seen = set()
-    return [el for el in interactive_elements if not (id(el) in seen or seen.add(id(el)))]
+    return soup.find_all(is_interactive_element)
 
 def inject_javascript(soup: BeautifulSoup, js_code: str):
     """
@@ -640,302 +788,216 @@ def inject_javascript(soup: BeautifulSoup, js_code: str):
         else:
             soup.append(script_tag)
 
-def fix_page_links(client, page: Page, functionality_file: str, final_dir: str, available_files: list, site: Site):
+def splice_script(html_content: str, js_code: str) -> str:
     """
-    Fixes links in the page to point to the correct local files by processing links in batches.
+    Inserts the injected-functionality script before the last closing body (or html) tag of the raw HTML.
     """
-    page_filename = os.path.basename(functionality_file)
-    output_file = os.path.join(final_dir, page_filename)
-    
-    # Read the HTML content
-    with open(functionality_file, "r", encoding="utf-8") as f:
-        html_content = f.read()
+    script = f'<script id="injected-functionality">{js_code}</script>'
     
-    # Parse the HTML with BeautifulSoup
-    soup = BeautifulSoup(html_content, "html.parser")
+    for pattern in (BODY_CLOSE_RE, HTML_CLOSE_RE):
+        match = None
+        for match in pattern.finditer(html_content):
+            pass
+        if match:
+            return html_content[:match.start()] + script + html_content[match.start():]
     
-    # Get a list of all available pages for linking
-    available_files_str = "\n".join(available_files)
-    
-    # Create a mapping of original URLs to local filenames
+    return html_content + script
+
+def normalize_url_keys(parsed_url):
+    """
+    Returns the full URL and the path of a parsed URL with the query, fragment and trailing slash dropped.
+    """
+    path = parsed_url.path.rstrip('/')
+    return parsed_url._replace(path=path, params="", query="", fragment="").geturl(), path
+
+def build_url_to_file_map(site: Site) -> dict:
+    """
+    Maps every page's URL and path to its local filename. Keys are normalized with
+    normalize_url_keys so lookups don't need every slash/query variant stored.
+    """
     url_to_file_map = {}
     for p in site.get_pages():
         safe_filename = sanitize_filename(p.dir) + ".html"
-        url_to_file_map[p.url] = safe_filename
         
-        # Also add the path component as a key
-        parsed_url = urlparse(p.url)
-        if parsed_url.path:
-            url_to_file_map[parsed_url.path] = safe_filename
-            # Add with and without trailing slash
-            path = parsed_url.path
-            url_to_file_map[path.rstrip('/')] = safe_filename
-            url_to_file_map[path + '/'] = safe_filename
-    
-    # Add the URL mapping to the available files info
-    url_mapping_info = "\n".join([f"Original URL: {url} -> Local file: {filename}" 
-                                 for url, filename in url_to_file_map.items()])
+        # Keep the exact URL too, so pages that only differ by query string stay distinct
+        url_to_file_map[p.url] = safe_filename
+        for key in normalize_url_keys(urlparse(p.url)):
+            if key:
+                url_to_file_map.setdefault(key, safe_filename)
     
-    # Parse the current page URL for relative link resolution
-    current_url_parsed = urlparse(page.url)
-    current_domain = f"{current_url_parsed.scheme}://{current_url_parsed.netloc}"
+    return url_to_file_map
+
+def resolve_local_link(absolute_url, url_to_file_map: dict):
+    """
+    Returns the local filename an internal link (already parsed and made absolute) points to, or None if no page matches.
+    """
+    exact_url = absolute_url._replace(fragment="").geturl()
+    for key in (exact_url, *normalize_url_keys(absolute_url)):
+        if key in url_to_file_map:
+            return url_to_file_map[key]
+    return None
+
+def resolve_page_href(original_href: str, page_url: str, available_files: frozenset, url_to_file_map: dict, site_domains: set):
+    """
+    Returns (local_file, needs_fix) for an href on a page: the local file it maps to directly,
+    or None with needs_fix set when it's an internal link no page mapping covers.
+    """
+    sanitized_name = get_sanitized_name_from_url("ubereats" + original_href)
+    if sanitized_name[1:] in map_url_to_file:
+        print(f"Mapped link: {original_href} -> {map_url_to_file[sanitized_name[1:]]}.html")
+        return map_url_to_file[sanitized_name[1:]] + ".html", False
+    
+    if not original_href:
+        return None, False
+    
+    # Skip links that are just anchors, or that aren't web links at all
+    if original_href.startswith(("#", "mailto:", "tel:", "javascript:")):
+        return None, False
+        
+    # Skip links that are already fixed (pointing to local HTML files)
+    if original_href in available_files:
+        return None, False
+        
+    # Skip links that are clearly external and not in our site
+    absolute_url = urlparse(urljoin(page_url, original_href))
+    if absolute_url.netloc not in site_domains:
+        return None, False
+    
+    # Most internal links resolve against the URL mapping without needing Claude
+    local_file = resolve_local_link(absolute_url, url_to_file_map)
+    if local_file:
+        print(f"Direct mapping found: {original_href} -> {local_file}")
+        return local_file, False
+    return None, True
+
+async def fix_page_links(page: Page, functionality_file: str, available_files: frozenset, url_to_file_map: dict, site_domains: set, soup: BeautifulSoup = None):
+    """
+    Resolves the links in a page that map directly to local files and returns the parsed page
+    along with the prompts for any links that still need Claude to resolve them.
+    Reuses the soup from step 2 when given, otherwise parses the functionality file.
+    """
+    if soup is None:
+        async with aiofiles.open(functionality_file, "r", encoding="utf-8") as f:
+            html_content = await f.read()
+        
+        # A page without any anchors has nothing to fix, so skip parsing it
+        if not LINK_TAG_RE.search(html_content):
+            print(f"No links found in {page.url}")
+            return None, [], False
+        soup = await asyncio.to_thread(BeautifulSoup, html_content, "lxml")
     
     # Find all links in the page
     links = soup.find_all("a", href=True)
     
     if not links:
         print(f"No links found in {page.url}")
-        # Just copy the file to the output directory
-        shutil.copy(functionality_file, output_file)
-        return
+        return soup, [], False
     
     print(f"Found {len(links)} links in {page.url}")
     
-    # Filter links that need processing
-    links_to_process = []
-    link_elements = {}  # Map to store link elements by ID
+    # Links that could not be mapped directly, paired with the prompt that asks Claude to fix them
+    unresolved_links = []
     
-    for i, link in enumerate(links):
-
+    # Whether any href was rewritten, so unchanged pages can be copied instead of reserialized
+    links_changed = False
+    
+    # Pages repeat the same hrefs many times (nav bars, store cards), so each distinct href is resolved once
+    resolved_hrefs = {}
+    
+    # How many links were mapped locally, to keep track of how few are left for Claude
+    mapped_count = 0
+    
+    for link in links:
         original_href = link.get("href", "")
-        sanitized_name = get_sanitized_name_from_url("ubereats" + original_href)
-        if sanitized_name[1:] in map_url_to_file:
-            link["href"] = map_url_to_file[sanitized_name[1:]] + ".html"
-            print(f"Mapped link: {original_href} -> {map_url_to_file[sanitized_name[1:]]}.html")
-
-        """ original_href = link.get("href", "")
-        link_text = link.get_text().strip()
+        if original_href not in resolved_hrefs:
+            resolved_hrefs[original_href] = resolve_page_href(original_href, page.url, available_files, url_to_file_map, site_domains)
+        local_file, needs_fix = resolved_hrefs[original_href]
         
-        if not original_href:
+        if local_file:
+            link["href"] = local_file
+            links_changed = True
+            mapped_count += 1
             continue
         
-        # Skip links that are just anchors
-        if original_href.startswith("#"):
-            continue
-            
-        # Skip links that are already fixed (pointing to local HTML files)
-        if original_href.endswith(".html") and any(original_href == file for file in available_files):
-            continue
-            
-        # Skip links that are clearly external and not in our site
-        if (original_href.startswith("http") and 
-            not any(domain in original_href for domain in [current_domain] + 
-                   [urlparse(url).netloc for url in url_to_file_map.keys() if '://' in url])):
+        # Without the LLM fallback, links that don't map directly are left as they are
+        if not needs_fix or not LLM_LINK_FIX_ENABLED:
             continue
         
-        # Try to resolve relative links to absolute URLs for better matching
-        if not original_href.startswith(('http://', 'https://', 'mailto:', 'tel:')):
-            # Handle root-relative links (starting with /)
-            if original_href.startswith('/'):
-                absolute_href = f"{current_domain}{original_href}"
-            else:
-                # Handle relative links (not starting with /)
-                base_path = '/'.join(current_url_parsed.path.split('/')[:-1])
-                if not base_path.endswith('/'):
-                    base_path += '/'
-                absolute_href = f"{current_domain}{base_path}{original_href}"
-                
-            # Check if we already have a mapping for this resolved URL
-            if absolute_href in url_to_file_map:
-                link["href"] = url_to_file_map[absolute_href]
-                print(f"Direct mapping found: {original_href} -> {url_to_file_map[absolute_href]}")
-                continue
-        
-        # Add this link to the batch for processing
-        link_id = f"link_{i}"
-        links_to_process.append({
-            "id": link_id,
-            "href": original_href,
-            "text": link_text
-        })
-        link_elements[link_id] = link
-    
-    # If no links need processing, just write the file and return
-    if not links_to_process:
-        print(f"No links need processing for {page.url}")
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write(str(soup))
-        return
-    
-    # Process links in batches of 25 (reduced from 50 to avoid token limit issues)
-    batch_size = 25
-    links_updated = 0
-    failed_links = []  # Track links that failed in batch processing
-    
-    for i in range(0, len(links_to_process), batch_size):
-        batch = links_to_process[i:i+batch_size]
-        
-        # Format the links for the prompt
-        links_to_fix_str = "\n".join([
-            f"Link ID: {link['id']}\nOriginal link: {link['href']}\nLink text: {link['text']}\n"
-            for link in batch
-        ])
+        link_text = link.get_text().strip()
         
-        # Prepare the batch prompt
-        batch_prompt = BATCH_LINK_FIX_PROMPT.format(
+        # Queue this link for the site-wide batch
+        link_prompt = LINK_FIX_PROMPT.format(
+            original_link=original_href,
             page_url=page.url,
-            available_files=available_files_str,
-            url_mapping=url_mapping_info,
-            links_to_fix=links_to_fix_str
+            link_text=link_text
         )
-        print(batch_prompt)
-        
-        try:
-            # Call Anthropic to fix this batch of links
-            response = client.messages.create(
-                model="claude-3-7-sonnet-20250219",
-                max_tokens=2000,  # Increased token limit for batch processing
-                temperature=0,
-                system=SYSTEM_PROMPT,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": batch_prompt
-                    }
-                ]
-            )
-            
-            print(response.content[0].text)
-            # Get the corrected links as JSON
-            response_text = response.content[0].text.strip()
-            print(response_text)
-            
-            # Extract JSON from the response if it's wrapped in code blocks
-            if "```json" in response_text and "```" in response_text.split("```json", 1)[1]:
-                json_str = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text and "```" in response_text.split("```", 1)[1]:
-                json_str = response_text.split("```")[1].split("```")[0].strip()
-            else:
-                json_str = response_text
-            
-            # Parse the JSON response
-            try:
-                # Clean up the JSON string to handle potential formatting issues
-                # Remove any leading/trailing whitespace and ensure it starts with {
-                json_str = json_str.strip()
-                if not json_str.startswith('{'):
-                    # Find the first occurrence of { and start from there
-                    start_idx = json_str.find('{')
-                    if start_idx != -1:
-                        json_str = json_str[start_idx:]
-                    else:
-                        raise ValueError("No JSON object found in response")
-                
-                # Find the last occurrence of } to handle any trailing text
-                end_idx = json_str.rfind('}')
-                if end_idx != -1:
-                    json_str = json_str[:end_idx+1]
-                
-                # Try to parse the cleaned JSON
-                try:
-                    corrected_links = json.loads(json_str)
-                except json.JSONDecodeError:
-                    # If still failing, try a more aggressive cleanup approach
-                    # This handles cases where there might be line breaks or other characters in the JSON
-                    import re
-                    # Extract what looks like a JSON object
-                    json_match = re.search(r'\{.*\}', json_str, re.DOTALL)
-                    if json_match:
-                        json_str = json_match.group(0)
-                        # Replace any problematic characters
-                        json_str = re.sub(r'[\n\r\t]', '', json_str)
-                        corrected_links = json.loads(json_str)
-                    else:
-                        raise ValueError("Could not extract valid JSON from response")
-                
-                # Update the links in the soup
-                for link_id, corrected_href in corrected_links.items():
-                    if link_id in link_elements:
-                        link_element = link_elements[link_id]
-                        original_href = link_element.get("href", "")
-                        
-                        if corrected_href and corrected_href != original_href:
-                            link_element["href"] = corrected_href
-                            print(f"Updated link: {original_href} -> {corrected_href}")
-                            links_updated += 1
-                
-            except (json.JSONDecodeError, ValueError) as e:
-                print(f"Error parsing JSON response for batch {i//batch_size + 1}: {e}")
-                print(f"Response was: {json_str}")
-                # Log the full response for debugging
-                debug_dir = os.path.join(os.path.dirname(final_dir), "debug")
-                os.makedirs(debug_dir, exist_ok=True)
-                debug_file = os.path.join(debug_dir, f"{page_filename}_batch_{i//batch_size + 1}_response.txt")
-                with open(debug_file, "w", encoding="utf-8") as f:
-                    f.write(f"Original response:\n{response_text}\n\nExtracted JSON:\n{json_str}")
-                print(f"Full response saved to {debug_file}")
-                
-                # Add all links in this batch to the failed links list for individual processing
-                failed_links.extend(batch)
-                
-        except Exception as e:
-            print(f"Error processing batch {i//batch_size + 1}: {e}")
-            # Add all links in this batch to the failed links list for individual processing
-            failed_links.extend(batch)
-    
-    # Process any failed links individually as a fallback
-    if failed_links:
-        print(f"Processing {len(failed_links)} failed links individually as fallback")
-        individual_success = 0
-        
-        for link_info in failed_links:
-            link_id = link_info["id"]
-            original_href = link_info["href"]
-            link_text = link_info["text"]
-            
-            if link_id not in link_elements:
-                continue
-                
-            link_element = link_elements[link_id]
-            
-            # Prepare the prompt for this specific link
-            link_prompt = LINK_FIX_PROMPT.format(
-                original_link=original_href,
-                page_url=page.url,
-                link_text=link_text,
-                available_files=available_files_str,
-                url_mapping=url_mapping_info
-            )
-            
-            try:
-                # Call Anthropic to fix this specific link
-                response = client.messages.create(
-                    model="claude-3-7-sonnet-20250219",
-                    max_tokens=100,  # Small token limit since we only need a simple response
-                    temperature=0,
-                    system=SYSTEM_PROMPT,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": link_prompt
-                        }
+        unresolved_links.append((link, link_prompt))
+    
+    print(f"  {page.url}: {mapped_count} links mapped locally, {len(unresolved_links)} left for Claude, "
+          f"{len(links) - mapped_count - len(unresolved_links)} left as they are")
+    return soup, unresolved_links, links_changed
+
+async def fix_links_with_batch(client, link_prompts: dict, link_fix_context: str) -> dict:
+    """
+    Sends every unresolved link prompt as a single Message Batch and returns the corrected links by custom_id.
+    The shared site context goes first in each request and is marked for prompt caching.
+    """
+    link_requests = {
+        custom_id: {
+            "model": MODEL,
+            "max_tokens": 100,  # Small token limit since we only need a simple response
+            "temperature": 0,
+            "system": CACHED_SYSTEM_PROMPT,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": link_fix_context, "cache_control": {"type": "ephemeral"}},
+                        {"type": "text", "text": link_prompt}
                     ]
-                )
-                
-                # Get the corrected link
-                corrected_link = response.content[0].text.strip()
-                
-                # Update the link in the soup
-                if corrected_link and corrected_link != original_href:
-                    link_element["href"] = corrected_link
-                    print(f"Updated link (individual): {original_href} -> {corrected_link}")
-                    links_updated += 1
-                    individual_success += 1
-                    
-            except Exception as e:
-                print(f"Error fixing individual link {original_href}: {e}")
-        
-        print(f"Individual processing complete: {individual_success}/{len(failed_links)} links fixed") """
+                }
+            ]
+        }
+        for custom_id, link_prompt in link_prompts.items()
+    }
     
-    print(map_url_to_file)
-    # Write the updated HTML to the output file
-    with open(output_file, "w", encoding="utf-8") as f:
-        f.write(str(soup))
-        
-    #print(f"Fixed {links_updated} links for {page.url}")
+    # Links answered on a previous run don't need to be sent again
+    corrected_links = {}
+    for custom_id, params in list(link_requests.items()):
+        message = await read_cached_message(params)
+        if message is not None:
+            corrected_links[custom_id] = message.content[0].text.strip()
+            del link_requests[custom_id]
+    
+    if not link_requests:
+        return corrected_links
+    
+    batch = await client.messages.batches.create(
+        requests=[{"custom_id": custom_id, "params": params} for custom_id, params in link_requests.items()]
+    )
+    print(f"Submitted {len(link_requests)} links to fix in batch {batch.id}")
+    
+    # Batches are processed asynchronously, so poll until every request has finished
+    while batch.processing_status != "ended":
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+        batch = await client.messages.batches.retrieve(batch.id)
+    
+    async for entry in await client.messages.batches.results(batch.id):
+        if entry.result.type == "succeeded":
+            corrected_links[entry.custom_id] = entry.result.message.content[0].text.strip()
+            await write_cached_message(link_requests[entry.custom_id], entry.result.message)
+        else:
+            print(f"  Error fixing link {entry.custom_id}: {entry.result.type}")
+    
+    return corrected_links
 
+@functools.cache
 def sanitize_filename(filename: str) -> str:
-    """Replace any problematic filesystem characters."""
-    sanitized = re.sub(r'[\\/*?:"<>|]', '_', filename)
+    """
+    Replace any problematic filesystem characters. Also records the name in map_url_to_file,
+    which resolve_page_href uses to map links straight to local files; since results are
+    cached, that happens on the first call for each name.
+    """
+    sanitized = SANITIZE_RE.sub('_', filename)
     map_url_to_file[filename] = sanitized
     return sanitized 
\ No newline at end of file
@@ -2,6 +2,7 @@ import os
 import time
 import uuid
 import asyncio
+import collections
 from data_models import Site, Page, Interaction
 from utils import screenshot_page
 
@@ -31,14 +32,28 @@ class LoggedResponse:
     def __repr__(self):
         return f"<LoggedResponse {self.status} for {self.request.url}. Response: {self.raw}>"
 
+# Most unmatched requests the backlog keeps before dropping the oldest
+REQUEST_BACKLOG_LIMIT = 5000
+
+# Most requests the logger keeps a lookup entry for; older ones are evicted first
+REQUEST_LOOKUP_LIMIT = 4096
+
+# Sets a key in an OrderedDict used as an LRU, evicting the oldest entry past the limit
+def lru_set(mapping: collections.OrderedDict, key, value, limit: int = REQUEST_LOOKUP_LIMIT):
+    mapping[key] = value
+    mapping.move_to_end(key)
+    if len(mapping) > limit:
+        mapping.popitem(last=False)
+
 # The InteractionLogger maps user interactions with network events.
 class InteractionLogger:
     def __init__(self):
         self.interactions = []
-        self.request_backlog = []
-        self.request_to_interaction = {}
+        self.request_backlog = collections.deque(maxlen=REQUEST_BACKLOG_LIMIT)
+        # Both lookups are bounded so a long manual session doesn't grow them forever
+        self.request_to_interaction = collections.OrderedDict()
         # Map raw Playwright requests (using id()) to our LoggedRequest instances.
-        self.playwright_to_logged = {}
+        self.playwright_to_logged = collections.OrderedDict()
 
     async def log_interaction(self, interaction: Interaction):
         self.interactions.append(interaction)
@@ -46,22 +61,35 @@ class InteractionLogger:
 
         # Process any requests that happened shortly before the interaction.
         # Use a slightly longer window to catch more related requests
-        backlog_to_process = []
-        for req in self.request_backlog:
+        cutoff = timestamp - 1.0  # Increased from 0.5 to 1.0
+
+        # Interactions are logged in time order, so a backlogged request outside this
+        # window can't match a later interaction either. The whole backlog is drained
+        # in one pass instead of removing matches from a list one by one.
+        while self.request_backlog:
+            logged_request = self.request_backlog.popleft()
             # Only process POST requests
-            if req.method == "POST" and req.timestamp > timestamp - 1.0:  # Increased from 0.5 to 1.0
-                backlog_to_process.append(req)
-                
-        for logged_request in backlog_to_process:
-            self.request_backlog.remove(logged_request)
-            self.request_to_interaction[logged_request.id] = interaction
-            interaction.add_request(logged_request)
+            if logged_request.method == "POST" and logged_request.timestamp > cutoff:
+                lru_set(self.request_to_interaction, logged_request.id, interaction)
+                interaction.add_request(logged_request)
 
-        # Don't clear remaining backlog - keep for potential future interactions
+    async def attribute_backlog(self, interaction: Interaction):
+        # Called once the page settles after an interaction. POSTs that fired more than
+        # 2 seconds after the click but before the page went idle land in the backlog,
+        # so claim them here before the next interaction's drain discards them.
+        cutoff = interaction.timestamp - 1.0
+        remaining = collections.deque(maxlen=REQUEST_BACKLOG_LIMIT)
+        for logged_request in self.request_backlog:
+            if logged_request.method == "POST" and logged_request.timestamp > cutoff:
+                lru_set(self.request_to_interaction, logged_request.id, interaction)
+                interaction.add_request(logged_request)
+            else:
+                remaining.append(logged_request)
+        self.request_backlog = remaining
 
     async def add_request(self, logged_request: LoggedRequest):
         # Save mapping from the raw Playwright request to our logged request
-        self.playwright_to_logged[id(logged_request.raw)] = logged_request
+        lru_set(self.playwright_to_logged, id(logged_request.raw), logged_request)
 
         timestamp = logged_request.timestamp
 
@@ -69,7 +97,7 @@ class InteractionLogger:
         if self.interactions and self.interactions[-1].timestamp > timestamp - 2:
             current_interaction = self.interactions[-1]
             current_interaction.add_request(logged_request)
-            self.request_to_interaction[logged_request.id] = current_interaction
+            lru_set(self.request_to_interaction, logged_request.id, current_interaction)
         else:
             # Otherwise, add to backlog to be assigned later when an interaction occurs.
             self.request_backlog.append(logged_request)
@@ -144,6 +172,21 @@ async def manual_workflow(playwright_page, start_url):
 
             await screenshot_page(playwright_page, current_page)
 
+    # Interaction screenshots run in the background so the click handler returns straight
+    # away and later network events aren't held up. They're awaited when the session ends.
+    screenshot_tasks = []
+
+    async def screenshot_interaction(interaction: Interaction, screenshot_path: str):
+        try:
+            await playwright_page.wait_for_load_state('networkidle')
+            await asyncio.sleep(0.2)
+            await playwright_page.screenshot(path=screenshot_path)
+            interaction.set_interaction_screenshot(screenshot_path)
+        except Exception as e:
+            print(f"Error taking interaction screenshot: {e}")
+        finally:
+            await logger.attribute_backlog(interaction)
+
     # We'll first track user interactions on the page
     async def on_page_interaction(event_data: dict):
 
@@ -161,24 +204,16 @@ async def manual_workflow(playwright_page, start_url):
             dom_path=event_data.get("domPath"),
             coordinates=(event_data.get("x"), event_data.get("y")),
         )
-        
-        # Take screenshot immediately after interaction
-        await playwright_page.wait_for_load_state('networkidle')
-        time.sleep(0.2)
-        screenshot_path = os.path.join("assets", current_page.dir, screenshot_filename)
-        await playwright_page.screenshot(path=screenshot_path)
-        
-        interaction.set_interaction_screenshot(screenshot_path)
         current_page.interactions.append(interaction)
         
-        # Log the interaction after screenshot is taken
+        # Log the interaction right away so requests it triggers are matched to it
         await logger.log_interaction(interaction)
+        
+        # Take the screenshot once the page settles after the interaction
+        screenshot_path = os.path.join("assets", current_page.dir, screenshot_filename)
+        screenshot_tasks.append(asyncio.create_task(screenshot_interaction(interaction, screenshot_path)))
     
     async def on_request(request):
-        # Only process POST requests
-        if request.method != "POST":
-            return
-            
         # Wrap the raw request in a LoggedRequest
         logged_request = LoggedRequest(request)
         
@@ -188,16 +223,9 @@ async def manual_workflow(playwright_page, start_url):
         # If we have a current interaction, add it directly
         if logger.interactions and time.time() - logger.interactions[-1].timestamp < 2:
             logger.interactions[-1].add_request(logged_request)
-            logger.request_to_interaction[logged_request.id] = logger.interactions[-1]
+            lru_set(logger.request_to_interaction, logged_request.id, logger.interactions[-1])
 
     async def on_response(response):
-        # Get the raw request from the response
-        raw_req = response.request
-        
-        # Only process responses for POST requests
-        if raw_req.method != "POST":
-            return
-            
         await logger.add_response(response)
         
     await playwright_page.expose_function("notify_click", on_page_interaction)
@@ -211,13 +239,19 @@ async def manual_workflow(playwright_page, start_url):
         except Exception as e:
             print(f"Error in frame navigation handler: {e}")
     
+    # Only POST requests and their responses are logged. The method is checked here, before
+    # a task is created, since the page fires these events for every image, script and font.
     def request_handler(request):
+        if request.method != "POST":
+            return
         try:
             asyncio.create_task(on_request(request))
         except Exception as e:
             print(f"Error in request handler: {e}")
     
     def response_handler(response):
+        if response.request.method != "POST":
+            return
         try:
             asyncio.create_task(on_response(response))
         except Exception as e:
@@ -240,6 +274,9 @@ async def manual_workflow(playwright_page, start_url):
         playwright_page.remove_listener("request", request_handler)
         playwright_page.remove_listener("response", response_handler)
         
+        # Let any pending interaction screenshots finish before the browser is closed
+        await asyncio.gather(*screenshot_tasks, return_exceptions=True)
+        
         print("Manual workflow completed and cleaned up.")
 
     return site